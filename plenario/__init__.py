@@ -4,6 +4,7 @@ from raven.contrib.flask import Sentry
 from plenario.database import session as db_session
 from plenario.models import bcrypt
 from plenario.api import api, cache
+from plenario.stats import stats
 from plenario.auth import auth, login_manager
 from plenario.views import views
 from plenario.utils.helpers import mail, slugify as slug
@@ -30,6 +31,7 @@ def create_app():
     app.register_blueprint(views)
     app.register_blueprint(auth)
     cache.init_app(app)
+    stats.init_app(app)
 
     @app.before_request
     def check_maintenance_mode():
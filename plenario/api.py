@@ -1,6 +1,8 @@
 from flask import make_response, request, render_template, current_app, g, \
-    Blueprint, abort, session as flask_session
+    Blueprint, abort, Response, stream_with_context, redirect, send_file, \
+    has_request_context, session as flask_session
 from flask.ext.cache import Cache
+from flask_login import login_required
 from functools import update_wrapper
 import os
 import re
@@ -11,9 +13,24 @@ from datetime_truncate import truncate
 import time
 import json
 import string
-from sqlalchemy import func, distinct, Column, Float, Table, text
-from sqlalchemy.exc import NoSuchTableError
-from sqlalchemy.types import NullType
+import zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+from sqlalchemy import func, distinct, Column, Float, Table, text, tuple_, \
+    and_, or_, BigInteger, String, select, union_all, literal, null, exists, \
+    literal_column
+from sqlalchemy.dialects.postgresql import TIMESTAMP, DOUBLE_PRECISION
+from sqlalchemy import event
+from sqlalchemy.exc import NoSuchTableError, OperationalError
+from sqlalchemy.types import NullType, Boolean, Integer, Numeric, Date, \
+    DateTime, Time
 from sqlalchemy.sql.expression import cast
 from geoalchemy2 import Geometry
 from operator import itemgetter
@@ -21,23 +38,58 @@ from itertools import groupby
 from cStringIO import StringIO
 import csv
 from shapely.wkb import loads
-from shapely.geometry import box, asShape
+from shapely.geometry import box, asShape, mapping
 from collections import OrderedDict
 from urlparse import urlparse
-
-from plenario.models import MasterTable, MetaTable
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha1
+from werkzeug.datastructures import MultiDict
+from threading import Lock
+from weakref import WeakKeyDictionary
+from uuid import uuid4
+
+from plenario.models import MasterTable, MetaTable, MasterDailyCount, \
+    MasterGridCount
 from plenario.database import session, app_engine as engine, Base
-from plenario.utils.helpers import get_socrata_data_info, slugify, increment_datetime_aggregate, send_mail
-from plenario.tasks import add_dataset
-from plenario.settings import CACHE_CONFIG
+from plenario.schema import registry
+from plenario.stats import stats
+from plenario.utils.helpers import get_socrata_data_info, slugify, send_mail, \
+    datetime_aggregate_range, fill_datetime_aggregate, getSizeInDegrees, \
+    GRID_RESOLUTIONS, GRID_CENTER
+from plenario.tasks import add_dataset, export_detail
+from plenario.settings import CACHE_CONFIG, AWS_ACCESS_KEY, AWS_SECRET_KEY, \
+    S3_BUCKET, QUERY_COST_LIMIT, STATEMENT_TIMEOUTS
+from boto.s3.connection import S3Connection
 
 cache = Cache(config=CACHE_CONFIG)
 
 API_VERSION = '/v1'
 RESPONSE_LIMIT = 1000
+STREAM_CHUNK_SIZE = 1000
+MAX_GEOJSON_PRECISION = 15
+PRECISION_ERROR = "'precision' must be a whole number from 0 to %s" \
+    % MAX_GEOJSON_PRECISION
 CACHE_TIMEOUT = 60*60*6
 VALID_DATA_TYPE = ['csv', 'json', 'geojson']
+COLUMNAR_DATA_TYPE = ['arrow', 'parquet']
 VALID_AGG = ['day', 'week', 'month', 'quarter', 'year']
+BATCH_ENDPOINTS = ['timeseries', 'detail-aggregate', 'grid']
+MAX_BATCH_QUERIES = 20
+EXPORT_URL_EXPIRES = 60*60
+EXPORT_JOB_PREFIX = 'export-'
+EXPORT_QUEUED = 'QUEUED'
+SIMPLIFY_VERTICES = 1000
+SIMPLIFY_TOLERANCE = 0.00001 # degrees, about a meter
+SUBDIVIDE_VERTICES = 256
+GEOMETRY_CACHE_SIZE = 256
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+# Already compressed on the way out, gzipping them again buys nothing
+PRECOMPRESSED_MIMETYPES = ['application/vnd.apache.parquet']
+MAX_FILTER_PLANS = 1000
+# Views that default to a window of the last 30 or 90 days
+DEFAULT_DATES_ENDPOINTS = ['api.dataset', 'api.detail', 'api.detail_aggregate', 'api.tiles']
+NON_FILTER_PARAMS = ['offset', 'limit', 'order_by', 'weather', 'cursor', 'precision']
 
 WEATHER_COL_LOOKUP = {
     'daily': {
@@ -55,6 +107,18 @@ WEATHER_COL_LOOKUP = {
 }
 
 api = Blueprint('api', __name__)
+
+COMPRESS_ENCODINGS = ['gzip']
+if brotli is not None:
+    COMPRESS_ENCODINGS.insert(0, 'br')
+
+# Parsed location_geom__within geometries, most recently used last
+geometry_cache = OrderedDict()
+geometry_cache_lock = Lock()
+
+# make_query's filter plans by table, then by the params' keys
+filter_plans = WeakKeyDictionary()
+filter_plans_lock = Lock()
 dthandler = lambda obj: obj.isoformat() if isinstance(obj, date) else None
 
 def crossdomain(origin=None, methods=None, headers=None,
@@ -99,10 +163,263 @@ def crossdomain(origin=None, methods=None, headers=None,
     return decorator
 
 def make_cache_key(*args, **kwargs):
-    path = request.path
-    args = str(hash(frozenset(request.args.items())))
-    # print 'cache_key:', (path+args)
-    return (path + args).encode('utf-8')
+    """ 
+    Builds a cache key that is the same across processes for equivalent
+    queries. Query parameters (including repeated ones like 'center[]')
+    are put in a canonical form and the key includes the version stamp 
+    of each dataset the query touches so that when a dataset is added
+    or updated only the entries that depend on it stop being used.
+    """
+    g.cache_checked = True
+    key = request.path + request_fingerprint()
+    encoding = response_encoding()
+    if encoding:
+        # Compressed and uncompressed bodies are cached separately
+        key += '.' + encoding
+    return key.encode('utf-8')
+
+def request_fingerprint():
+    """ 
+    Hash of the request path, its normalized params and the versions of
+    the datasets it touches. Used for both the cache key and the ETag.
+    """
+    if getattr(g, 'request_fingerprint', None) is None:
+        path = request.path
+        params = []
+        for key, values in sorted(request.args.lists()):
+            params.append([key, [normalize_query_value(key, v) for v in values]])
+        versions = registry.dataset_versions()
+        datasets = []
+        for name in cache_dataset_names():
+            if name == '*':
+                datasets.append(sorted(versions.items()))
+            else:
+                datasets.append([name, versions.get(name)])
+        window = None
+        if uses_default_dates():
+            window = date.today()
+        fingerprint = json.dumps([path, params, datasets, window], default=dthandler)
+        g.request_fingerprint = sha1(fingerprint).hexdigest()
+    return g.request_fingerprint
+
+def uses_default_dates():
+    """ 
+    True when the view fills in an obs_date window counted back from 
+    today because the request did not give both ends of one. The same 
+    params then mean a different window every day, so the day has to
+    be part of the fingerprint and of Last-Modified.
+    """
+    if request.endpoint not in DEFAULT_DATES_ENDPOINTS:
+        return False
+    return not (request.args.get('obs_date__ge') and request.args.get('obs_date__le'))
+
+def dataset_last_modified():
+    """ 
+    Latest last_update of the datasets the request touches
+    """
+    versions = registry.dataset_versions()
+    names = cache_dataset_names()
+    if '*' in names:
+        names = versions.keys()
+    stamps = [versions[n][0] for n in names if versions.get(n) and versions[n][0]]
+    if uses_default_dates():
+        stamps.append(datetime.combine(date.today(), datetime.min.time()))
+    if not stamps:
+        return None
+    return max(stamps).replace(microsecond=0)
+
+def conditional(f):
+    """ 
+    Adds an ETag and Last-Modified to responses and answers requests 
+    whose If-None-Match or If-Modified-Since still hold with a 304 
+    before the cache is checked or any query runs. Data only changes 
+    when a dataset is loaded, which changes its version.
+    """
+    def wrapped_function(*args, **kwargs):
+        etag = request_fingerprint()
+        encoding = response_encoding()
+        if encoding:
+            etag += '-' + encoding
+        last_modified = dataset_last_modified()
+        if not_modified(etag, last_modified):
+            resp = current_app.response_class(status=304)
+            resp.headers['Access-Control-Allow-Origin'] = '*'
+            resp.headers['Vary'] = 'Accept-Encoding'
+        else:
+            resp = make_response(f(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+        resp.set_etag(etag)
+        if last_modified is not None:
+            resp.last_modified = last_modified
+        return resp
+    return update_wrapper(wrapped_function, f)
+
+def compressed(f):
+    """ 
+    Compresses the response with the best encoding the client accepts 
+    (brotli when the module is installed, otherwise gzip). It sits 
+    under the cache so the compressed bytes are what gets cached and 
+    hits are served without compressing again. Bodies smaller than 
+    COMPRESS_MIN_SIZE and streamed responses are sent as they are.
+    """
+    def wrapped_function(*args, **kwargs):
+        start = time.time()
+        resp = make_response(f(*args, **kwargs))
+        # Only runs on cache misses, see plenario.stats
+        g.view_ms = (time.time() - start) * 1000
+        resp.headers['Vary'] = 'Accept-Encoding'
+        encoding = response_encoding()
+        if encoding is None or resp.status_code != 200 or resp.is_streamed \
+            or resp.direct_passthrough or 'Content-Encoding' in resp.headers \
+            or resp.mimetype in PRECOMPRESSED_MIMETYPES:
+            return resp
+        body = resp.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return resp
+        start = time.time()
+        resp.set_data(compress_body(body, encoding))
+        g.compress_ms = (time.time() - start) * 1000
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+    return update_wrapper(wrapped_function, f)
+
+def response_encoding():
+    """ 
+    The Content-Encoding to compress the response with, or None
+    """
+    return request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(body) + c.flush()
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        return last_modified <= since.replace(tzinfo=None)
+    return False
+
+def normalize_query_value(key, value):
+    field = key.split('__')[0]
+    operator = key.split('__')[-1]
+    try:
+        if field == 'obs_date':
+            return parse(value).isoformat()
+        elif operator == 'within':
+            return json.dumps(json.loads(value), sort_keys=True, separators=(',', ':'))
+        elif operator == 'in':
+            return ','.join(sorted(value.split(',')))
+        elif key == 'data_type':
+            return value.lower()
+    except (ValueError, TypeError, OverflowError):
+        pass
+    return value
+
+def cache_dataset_names():
+    """ 
+    Names of the datasets a cached API response depends on. '*' stands 
+    for every dataset.
+    """
+    if request.path.startswith(API_VERSION + '/api/weather'):
+        return []
+    names = []
+    if request.view_args and request.view_args.get('dataset_name'):
+        names.append(request.view_args['dataset_name'])
+    if request.args.get('dataset_name'):
+        names.append(request.args['dataset_name'])
+    if request.args.get('dataset_name__in'):
+        names.extend(request.args['dataset_name__in'].split(','))
+    return sorted(set(names)) or ['*']
+
+def stream_requested():
+    return request.args.get('stream', '').lower() == 'true'
+
+class QueryTooExpensive(Exception):
+    def __init__(self, cost, relation=None, rows=None):
+        self.cost = cost
+        self.relation = relation
+        self.rows = rows
+        Exception.__init__(self, cost)
+
+@event.listens_for(engine, 'begin')
+def set_statement_timeout(connection):
+    """ 
+    Caps how long any one query an API request runs can take. Listening on
+    the engine rather than the session also covers the engine.begin()
+    blocks (meta, the approved dataset names, registry version checks).
+    SET LOCAL only lasts until the end of the transaction.
+    """
+    if not has_request_context() or request.blueprint != 'api':
+        return
+    endpoint = request.endpoint.split('.')[-1]
+    timeout = STATEMENT_TIMEOUTS.get(endpoint, STATEMENT_TIMEOUTS.get('default'))
+    if timeout:
+        connection.execute('SET LOCAL statement_timeout = %d' % int(timeout))
+
+@api.errorhandler(QueryTooExpensive)
+def query_too_expensive(e):
+    narrow = ['obs_date']
+    if request.args.get('location_geom__within'):
+        narrow.append('location_geom__within')
+    message = "This query is estimated to cost %d which is over the limit of %d." \
+        % (e.cost, QUERY_COST_LIMIT)
+    if e.relation:
+        message += " Most of that is reading about %d rows from '%s'." \
+            % (e.rows, e.relation)
+    message += " Try narrowing %s." % ' or '.join(narrow)
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': message,
+            'cost': e.cost,
+            'cost_limit': QUERY_COST_LIMIT,
+            'narrow': narrow,
+        },
+        'objects': [],
+    }
+    return make_guard_response(resp)
+
+@api.errorhandler(OperationalError)
+def query_timed_out(e):
+    # 57014 is query_canceled, which is what statement_timeout raises
+    if getattr(e.orig, 'pgcode', None) != '57014':
+        raise
+    endpoint = request.endpoint.split('.')[-1]
+    timeout = STATEMENT_TIMEOUTS.get(endpoint, STATEMENT_TIMEOUTS.get('default'))
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': "This query took longer than %s seconds. Try narrowing "\
+                "the obs_date range or the area of location_geom__within." \
+                % (timeout / 1000.0),
+        },
+        'objects': [],
+    }
+    return make_guard_response(resp)
+
+def make_guard_response(resp):
+    resp = make_response(json.dumps(resp, default=dthandler), 400)
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@api.route(API_VERSION + '/api/_stats')
+@login_required
+def request_stats():
+    """ 
+    Latency, SQL and cache counters of the process that answers this
+    request (see plenario.stats). Only for logged in users since it 
+    has the text of the slowest SQL statements.
+    """
+    resp = make_response(json.dumps(stats.snapshot(), default=dthandler))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
 
 @api.route(API_VERSION + '/api/flush-cache')
 def flush_cache():
@@ -112,7 +429,9 @@ def flush_cache():
     return resp
 
 @api.route(API_VERSION + '/api/datasets')
-#@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def meta():
     status_code = 200
@@ -132,15 +451,8 @@ def meta():
                 m.longitude, m.observed_date, m.human_name, m.dataset_name, 
                 m.update_freq, ST_AsGeoJSON(m.bbox) as bbox
         FROM meta_master AS m 
-        LEFT JOIN celery_taskmeta AS c 
-          ON c.id = (
-            SELECT id FROM celery_taskmeta 
-            WHERE task_id = ANY(m.result_ids) 
-            ORDER BY date_done DESC 
-            LIMIT 1
-          )
         WHERE m.approved_status = 'true'
-        AND c.status = 'SUCCESS'
+        AND m.last_task_status = 'SUCCESS'
     '''
 
     if dataset_name:
@@ -166,13 +478,13 @@ def meta():
     return resp
 
 @api.route(API_VERSION + '/api/fields/<dataset_name>/')
-@cache.cached(timeout=CACHE_TIMEOUT)
+@conditional
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def dataset_fields(dataset_name):
     try:
-        table = Table('dat_%s' % dataset_name, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
+        table = registry.get_dataset_table(dataset_name)
         data = {
             'meta': {
                 'status': 'ok',
@@ -207,18 +519,25 @@ def dataset_fields(dataset_name):
 
 @api.route(API_VERSION + '/api/weather-stations/')
 @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def weather_stations():
     #print "weather_stations()"
     raw_query_params = request.args.copy()
     #print "weather_stations(): raw_query_params=", raw_query_params
 
-    stations_table = Table('weather_stations', Base.metadata, 
-        autoload=True, autoload_with=engine, extend_existing=True)
+    stations_table = registry.get_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(stations_table,raw_query_params)
+    try:
+        precision = parse_precision(raw_query_params)
+    except ValueError:
+        valid_query = False
+        resp['meta']['message'] = PRECISION_ERROR
+        status_code = 400
     if valid_query:
         resp['meta']['status'] = 'ok'
-        base_query = session.query(stations_table)
+        base_query = session.query(stations_table, 
+            geojson_column(stations_table.c.location, precision))
         for clause in query_clauses:
             print "weather_stations(): filtering on clause", clause
             base_query = base_query.filter(clause)
@@ -226,8 +545,7 @@ def weather_stations():
         fieldnames = [f for f in stations_table.columns.keys()]
         for value in values:
             d = {f:getattr(value, f) for f in fieldnames}
-            loc = str(value.location)
-            d['location'] = loads(loc.decode('hex')).__geo_interface__
+            d['location'] = json.loads(value.location_geojson)
             resp['objects'].append(d)
     resp['meta']['query'] = raw_query_params
     resp = make_response(json.dumps(resp, default=dthandler), status_code)
@@ -236,46 +554,91 @@ def weather_stations():
 
 @api.route(API_VERSION + '/api/weather/<table>/')
 @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def weather(table):
     raw_query_params = request.args.copy()
+    datatype = raw_query_params.pop('data_type', 'json')
 
-    weather_table = Table('dat_weather_observations_%s' % table, Base.metadata,
-        autoload=True, autoload_with=engine, extend_existing=True)
-    stations_table = Table('weather_stations', Base.metadata, 
-        autoload=True, autoload_with=engine, extend_existing=True)
+    weather_table = registry.get_table('dat_weather_observations_%s' % table)
+    stations_table = registry.get_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(weather_table,raw_query_params)
+    if datatype not in ['json'] + COLUMNAR_DATA_TYPE:
+        valid_query = False
+        resp['meta']['message'] = "'%s' is an invalid output format" % datatype
+        status_code = 400
+    elif datatype in COLUMNAR_DATA_TYPE and pyarrow is None:
+        valid_query = False
+        resp['meta']['message'] = "'%s' output is not available" % datatype
+        status_code = 400
+    cursor = raw_query_params.get('cursor')
+    if cursor is not None:
+        try:
+            cursor_date, cursor_id = parse_cursor(cursor)
+        except ValueError:
+            valid_query = False
+            resp['meta']['message'] = "'%s' is not a valid cursor" % cursor
+            status_code = 400
+    try:
+        precision = parse_precision(raw_query_params)
+    except ValueError:
+        valid_query = False
+        resp['meta']['message'] = PRECISION_ERROR
+        status_code = 400
     if valid_query:
         resp['meta']['status'] = 'ok'
-        base_query = session.query(weather_table, stations_table)\
+        base_query = session.query(weather_table, stations_table, 
+                geojson_column(stations_table.c.location, precision))\
             .join(stations_table, 
             weather_table.c.wban_code == stations_table.c.wban_code)
         for clause in query_clauses:
             base_query = base_query.filter(clause)
 
         try:
-            base_query = base_query.order_by(getattr(weather_table.c, 'date').desc())
+            date_col = getattr(weather_table.c, 'date')
         except AttributeError:
-            base_query = base_query.order_by(getattr(weather_table.c, 'datetime').desc())
+            date_col = getattr(weather_table.c, 'datetime')
+        if cursor is not None:
+            # Keyset pagination: pick up right after the last row of the
+            # previous page instead of scanning past 'offset' rows
+            base_query = base_query.order_by(date_col.desc(), weather_table.c.id.desc())
+            if cursor_date is not None:
+                base_query = base_query.filter(
+                    tuple_(date_col, weather_table.c.id) < tuple_(cursor_date, cursor_id))
+        else:
+            base_query = base_query.order_by(date_col.desc())
         base_query = base_query.limit(RESPONSE_LIMIT) # returning the top 1000 records
-        if raw_query_params.get('offset'):
+        if raw_query_params.get('offset') and cursor is None:
             offset = raw_query_params['offset']
             base_query = base_query.offset(int(offset))
         values = [r for r in base_query.all()]
+        if cursor is not None:
+            resp['meta']['next_cursor'] = None
+            if len(values) == RESPONSE_LIMIT:
+                last = values[-1]
+                resp['meta']['next_cursor'] = make_cursor(getattr(last, date_col.name), last.id)
         weather_fields = weather_table.columns.keys()
+        if datatype in COLUMNAR_DATA_TYPE:
+            columns = list(weather_table.columns) + [c for c in stations_table.columns
+                if c.name not in weather_fields]
+            resp_cursor = resp['meta'].get('next_cursor')
+            resp = columnar_response(values, columns, datatype, 'weather_%s' % table)
+            if resp_cursor:
+                resp.headers['X-Next-Cursor'] = resp_cursor
+            return resp
         station_fields = stations_table.columns.keys()
         weather_data = {}
         station_data = {}
         for value in values:
             wd = {f: getattr(value, f) for f in weather_fields}
-            sd = {f: getattr(value, f) for f in station_fields}
             if weather_data.get(value.wban_code):
                 weather_data[value.wban_code].append(wd)
             else:
                 weather_data[value.wban_code] = [wd]
-            loc = str(value.location)
-            sd['location'] = loads(loc.decode('hex')).__geo_interface__
-            station_data[value.wban_code] = sd
+            if value.wban_code not in station_data:
+                sd = {f: getattr(value, f) for f in station_fields}
+                sd['location'] = json.loads(value.location_geojson)
+                station_data[value.wban_code] = sd
         for station_id in weather_data.keys():
             d = {
                 'station_info': station_data[station_id],
@@ -290,7 +653,9 @@ def weather(table):
 
 
 @api.route(API_VERSION + '/api/timeseries/')
+@conditional
 @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def dataset():
     raw_query_params = request.args.copy()
@@ -302,36 +667,15 @@ def dataset():
     else:
         del raw_query_params['agg']
 
-    # if no obs_date given, default to >= 90 days ago
-    if not raw_query_params.get('obs_date__ge'):
-        six_months_ago = datetime.now() - timedelta(days=90)
-        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
-
-    if not raw_query_params.get('obs_date__le'):
-        raw_query_params['obs_date__le'] = datetime.now().strftime('%Y-%m-%d') 
+    set_default_dates(raw_query_params)
 
     # set datatype
     datatype = 'json'
     if raw_query_params.get('data_type'):
         datatype = raw_query_params['data_type']
         del raw_query_params['data_type']
-    q = '''
-        SELECT m.dataset_name
-        FROM meta_master AS m 
-        LEFT JOIN celery_taskmeta AS c 
-          ON c.id = (
-            SELECT id FROM celery_taskmeta 
-            WHERE task_id = ANY(m.result_ids) 
-            ORDER BY date_done DESC 
-            LIMIT 1
-          )
-        WHERE m.approved_status = 'true'
-        AND c.status = 'SUCCESS'
-    '''
-    with engine.begin() as c:
-        dataset_names = [d[0] for d in c.execute(q)]
     
-    raw_query_params['dataset_name__in'] = ','.join(dataset_names)
+    raw_query_params['dataset_name__in'] = ','.join(approved_dataset_names())
 
     mt = MasterTable.__table__
     valid_query, query_clauses, resp, status_code = make_query(mt,raw_query_params)
@@ -353,16 +697,29 @@ def dataset():
         resp.headers['Content-Type'] = 'application/json'
 
     if valid_query:
-        time_agg = func.date_trunc(agg, mt.c['obs_date'])
-        base_query = session.query(time_agg, 
-            func.count(mt.c['obs_date']),
-            mt.c['dataset_name'])
-        base_query = base_query.filter(mt.c['current_flag'] == True)
+        daily_clauses = make_daily_query(raw_query_params)
+        if daily_clauses is not None:
+            # Answer from the pre-aggregated daily counts
+            dt = MasterDailyCount.__table__
+            time_agg = func.date_trunc(agg, cast(dt.c['obs_day'], TIMESTAMP))
+            base_query = session.query(time_agg, 
+                cast(func.sum(dt.c['obs_count']), BigInteger),
+                dt.c['dataset_name'])
+            group_col = dt.c['dataset_name']
+            query_clauses = daily_clauses
+        else:
+            time_agg = func.date_trunc(agg, mt.c['obs_date'])
+            base_query = session.query(time_agg, 
+                func.count(mt.c['obs_date']),
+                mt.c['dataset_name'])
+            group_col = mt.c['dataset_name']
         for clause in query_clauses:
             base_query = base_query.filter(clause)
-        base_query = base_query.group_by(mt.c['dataset_name'])\
+        base_query = base_query.group_by(group_col)\
             .group_by(time_agg)\
             .order_by(time_agg)
+        if daily_clauses is None:
+            check_query_cost(base_query)
         values = [o for o in base_query.all()]
 
         # init from and to dates ad python datetimes
@@ -372,35 +729,13 @@ def dataset():
         else:
             to_date = datetime.now()
 
-        # build the response
+        # build the response, filling in the buckets with no rows. The 
+        # buckets are the same for every dataset so only make them once.
+        buckets = datetime_aggregate_range(from_date, to_date, agg)
         results = sorted(values, key=itemgetter(2))
         for k,g in groupby(results, key=itemgetter(2)):
             d = {'dataset_name': k}
-
-            items = []
-            dense_matrix = []
-            cursor = from_date
-            v_index = 0
-            dataset_values = list(g)
-            while cursor <= to_date:
-                if v_index < len(dataset_values) and \
-                    dataset_values[v_index][0].replace(tzinfo=None) == cursor:
-                    dense_matrix.append((cursor, dataset_values[v_index][1]))
-                    v_index += 1
-                else:
-                    dense_matrix.append((cursor, 0))
-
-                cursor = increment_datetime_aggregate(cursor, agg)
-
-            dense_matrix = OrderedDict(dense_matrix)
-            for k in dense_matrix:
-                i = {
-                    'datetime': k,
-                    'count': dense_matrix[k],
-                    }
-                items.append(i)
-
-            d['items'] = items
+            d['items'] = fill_datetime_aggregate(buckets, g)
             resp['objects'].append(d)
 
         resp['meta']['query'] = raw_query_params
@@ -447,7 +782,9 @@ def dataset():
     return resp
 
 @api.route(API_VERSION + '/api/detail/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key, unless=stream_requested)
+@compressed
 @crossdomain(origin="*")
 def detail():
     raw_query_params = request.args.copy()
@@ -461,9 +798,14 @@ def detail():
     if raw_query_params.get('weather') is not None:
         include_weather = raw_query_params['weather']
         del raw_query_params['weather']
+    stream = stream_requested()
+    if raw_query_params.get('stream') is not None:
+        del raw_query_params['stream']
     agg, datatype, queries = parse_join_query(raw_query_params)
     order_by = raw_query_params.get('order_by')
     offset = raw_query_params.get('offset')
+    limit = raw_query_params.get('limit')
+    cursor = raw_query_params.get('cursor')
     mt = MasterTable.__table__
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
     if not raw_query_params.get('dataset_name'):
@@ -473,14 +815,47 @@ def detail():
             'message': "'dataset_name' is required"
         }
         resp['objects'] = []
+    elif cursor is not None:
+        try:
+            cursor_date, cursor_id = parse_cursor(cursor)
+        except ValueError:
+            valid_query = False
+            resp['meta']['message'] = "'%s' is not a valid cursor" % cursor
+            status_code = 400
+        if order_by:
+            valid_query = False
+            resp['meta']['message'] = "'cursor' can not be combined with 'order_by'"
+            status_code = 400
+        if stream:
+            # A streamed response has every row and goes out before the
+            # last one is known, so there is no next page to point to
+            valid_query = False
+            resp['meta']['message'] = "'cursor' can not be combined with 'stream'"
+            status_code = 400
+    try:
+        precision = parse_precision(raw_query_params)
+    except ValueError:
+        valid_query = False
+        resp['meta']['message'] = PRECISION_ERROR
+        status_code = 400
+    if datatype in COLUMNAR_DATA_TYPE and pyarrow is None:
+        valid_query = False
+        resp['meta']['message'] = "'%s' output is not available" % datatype
+        status_code = 400
+    values = []
+    columns = []
     if valid_query:
         resp['meta']['status'] = 'ok'
         dname = raw_query_params['dataset_name']
-        dataset = Table('dat_%s' % dname, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
+        dataset = registry.get_dataset_table(dname)
         dataset_fields = dataset.columns.keys()
-        base_query = session.query(mt, dataset)
+        columns = list(dataset.columns)
+        weather_fields = None
+        if datatype == 'csv' or datatype in COLUMNAR_DATA_TYPE:
+            base_query = session.query(mt, dataset)
+        else:
+            base_query = session.query(mt, dataset, 
+                geojson_column(mt.c.location_geom, precision))
         if include_weather:
             date_col_name = 'date'
             try:
@@ -494,9 +869,9 @@ def detail():
                 weather_tname = 'hourly'
             else:
                 weather_tname = 'daily'
-            weather_table = Table('dat_weather_observations_%s' % weather_tname, Base.metadata, 
-                autoload=True, autoload_with=engine, extend_existing=True)
+            weather_table = registry.get_table('dat_weather_observations_%s' % weather_tname)
             weather_fields = weather_table.columns.keys()
+            columns.extend(weather_table.columns)
             base_query = session.query(mt, dataset, weather_table)
         valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
         if valid_query:
@@ -525,50 +900,63 @@ def detail():
                     for clause in weather_clauses:
                         base_query = base_query.filter(clause)
             if valid_query:
-                if order_by:
+                if cursor is not None:
+                    # Keyset pagination: pick up right after the last row of
+                    # the previous page instead of scanning past 'offset' rows
+                    base_query = base_query.order_by(mt.c.obs_date.asc(), 
+                        mt.c.master_row_id.asc())
+                    if cursor_date is not None:
+                        base_query = base_query.filter(
+                            tuple_(mt.c.obs_date, mt.c.master_row_id) > \
+                                tuple_(cursor_date, cursor_id))
+                elif order_by:
                     col, order = order_by.split(',')
                     base_query = base_query.order_by(getattr(mt.c[col], order)())
                 else:
                     base_query = base_query.order_by(mt.c.master_row_id.asc())
-                base_query = base_query.limit(RESPONSE_LIMIT)
-                if offset:
+                # Streamed exports are not capped at RESPONSE_LIMIT; 
+                # they only stop early if the client asks for a limit.
+                if not stream:
+                    base_query = base_query.limit(RESPONSE_LIMIT)
+                elif limit:
+                    base_query = base_query.limit(int(limit))
+                if offset and cursor is None:
                     base_query = base_query.offset(int(offset))
-                values = [r for r in base_query.all()]
-                for value in values:
-                    d = {f:getattr(value, f) for f in dataset_fields}
-                    if value.location_geom is not None:
-                        d['location_geom'] = loads(value.location_geom.desc, hex=True).__geo_interface__
-                    if include_weather:
-                        d = {
-                            'observation': {f:getattr(value, f) for f in dataset_fields},
-                            'weather': {f:getattr(value, f) for f in weather_fields},
-                        }
-                    resp['objects'].append(d)
                 resp['meta']['query'] = raw_query_params
                 loc = resp['meta']['query'].get('location_geom__within')
                 if loc:
                     resp['meta']['query']['location_geom__within'] = json.loads(loc)
-                resp['meta']['total'] = len(resp['objects'])
-    if datatype == 'json':
-        resp = make_response(json.dumps(resp, default=dthandler), status_code)
+                check_query_cost(base_query)
+                if stream:
+                    # Use a server side (named) cursor so rows come back from
+                    # Postgres in batches rather than all at once
+                    values = base_query\
+                        .execution_options(stream_results=True)\
+                        .yield_per(STREAM_CHUNK_SIZE)
+                    return stream_detail(values, datatype, resp, 
+                        dataset_fields, weather_fields, dname, columns)
+                values = [r for r in base_query.all()]
+                resp['meta']['total'] = len(values)
+                if cursor is not None:
+                    resp['meta']['next_cursor'] = None
+                    if len(values) == RESPONSE_LIMIT:
+                        last = values[-1]
+                        resp['meta']['next_cursor'] = make_cursor(last.obs_date, 
+                            last.master_row_id)
+    next_cursor = resp['meta'].get('next_cursor')
+    if datatype in COLUMNAR_DATA_TYPE and resp['meta']['status'] == 'ok':
+        resp = columnar_response(values, columns, datatype, dname)
+    elif datatype == 'json' or datatype in COLUMNAR_DATA_TYPE:
+        rows = [dump_detail_row(v, dataset_fields, weather_fields) for v in values]
+        resp = make_response('{"objects": [%s], "meta": %s}' % (','.join(rows), 
+            json.dumps(resp['meta'], default=dthandler)), status_code)
         resp.headers['Content-Type'] = 'application/json'
     
     elif datatype == 'geojson' and not include_weather:
-        geojson_resp = {
-          "type": "FeatureCollection",
-          "features": []
-        }
-
-        for o in resp['objects']:
-            if o.get('location_geom'):
-                g = {
-                  "type": "Feature",
-                  "geometry": o['location_geom'],
-                  "properties": {f:getattr(value, f) for f in o}
-                }
-                geojson_resp['features'].append(g)
-
-        resp = make_response(json.dumps(geojson_resp, default=dthandler), status_code)
+        features = [dump_detail_feature(v, dataset_fields) for v in values 
+                    if v.location_geojson is not None]
+        resp = make_response('{"type": "FeatureCollection", "features": [%s]}' \
+            % ','.join(features), status_code)
         resp.headers['Content-Type'] = 'application/json'
     elif datatype == 'csv':
         csv_resp = [dataset_fields]
@@ -580,15 +968,18 @@ def detail():
                 d.extend([getattr(value, f) for f in weather_fields])
             csv_resp.append(d)
         resp = make_response(make_csv(csv_resp), 200)
-        filedate = datetime.now().strftime('%Y-%m-%d')
         dname = raw_query_params['dataset_name']
         filedate = datetime.now().strftime('%Y-%m-%d')
         resp.headers['Content-Type'] = 'text/csv'
         resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (dname, filedate)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
     return resp
 
 @api.route(API_VERSION + '/api/detail-aggregate/')
+@conditional
 @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def detail_aggregate():
     raw_query_params = request.args.copy()
@@ -596,13 +987,7 @@ def detail_aggregate():
     if not agg:
         agg = 'day'
 
-    # if no obs_date given, default to >= 90 days ago
-    if not raw_query_params.get('obs_date__ge'):
-        six_months_ago = datetime.now() - timedelta(days=90)
-        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
-
-    if not raw_query_params.get('obs_date__le'):
-        raw_query_params['obs_date__le'] = datetime.now().strftime('%Y-%m-%d') 
+    set_default_dates(raw_query_params)
 
     mt = MasterTable.__table__
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
@@ -627,11 +1012,12 @@ def detail_aggregate():
         time_agg = func.date_trunc(agg, mt.c['obs_date'])
         base_query = session.query(time_agg, func.count(mt.c.dataset_row_id))
         dname = raw_query_params.get('dataset_name')
+        daily_clauses = None
+        if dname:
+            daily_clauses = make_daily_query(dict(queries['base'], **queries['detail']))
 
         try:
-            dataset = Table('dat_%s' % dname, Base.metadata,
-                autoload=True, autoload_with=engine,
-                extend_existing=True)
+            dataset = registry.get_dataset_table(dname)
             valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
         except:
             valid_query = False
@@ -643,14 +1029,27 @@ def detail_aggregate():
             resp = make_response(json.dumps(resp, default=dthandler), 400)
             resp.headers['Content-Type'] = 'application/json'
 
-        if valid_query:
+        if valid_query and daily_clauses is not None:
+            # No filters on the dataset's own columns or on location so 
+            # the pre-aggregated daily counts can answer this
+            dt = MasterDailyCount.__table__
+            time_agg = func.date_trunc(agg, cast(dt.c['obs_day'], TIMESTAMP))
+            base_query = session.query(time_agg, 
+                cast(func.sum(dt.c['obs_count']), BigInteger))
+            for clause in daily_clauses:
+                base_query = base_query.filter(clause)
+            values = [r for r in base_query.group_by(time_agg).order_by(time_agg).all()]
+        elif valid_query:
             pk = [p.name for p in dataset.primary_key][0]
             base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
             for clause in base_clauses:
                 base_query = base_query.filter(clause)
             for clause in detail_clauses:
                 base_query = base_query.filter(clause)
-            values = [r for r in base_query.group_by(time_agg).order_by(time_agg).all()]
+            base_query = base_query.group_by(time_agg).order_by(time_agg)
+            check_query_cost(base_query)
+            values = [r for r in base_query.all()]
+        if valid_query:
             
             # init from and to dates ad python datetimes
             from_date = truncate(parse(raw_query_params['obs_date__ge']), agg)
@@ -659,27 +1058,8 @@ def detail_aggregate():
             else:
                 to_date = datetime.now()
 
-            items = []
-            dense_matrix = []
-            cursor = from_date
-            v_index = 0
-            while cursor <= to_date:
-                if v_index < len(values) and \
-                    values[v_index][0].replace(tzinfo=None) == cursor:
-                    dense_matrix.append((cursor, values[v_index][1]))
-                    v_index += 1
-                else:
-                    dense_matrix.append((cursor, 0))
-
-                cursor = increment_datetime_aggregate(cursor, agg)
-
-            dense_matrix = OrderedDict(dense_matrix)
-            for k in dense_matrix:
-                i = {
-                    'datetime': k,
-                    'count': dense_matrix[k],
-                    }
-                items.append(i)
+            buckets = datetime_aggregate_range(from_date, to_date, agg)
+            items = fill_datetime_aggregate(buckets, values)
 
             if datatype == 'json':
                 resp['objects'] = items
@@ -704,13 +1084,13 @@ def detail_aggregate():
     return resp
 
 @api.route(API_VERSION + '/api/grid/')
+@conditional
 @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def grid():
     raw_query_params = request.args.copy()
 
-    buff = request.args.get('buffer', 100)
-    
     resolution = request.args.get('resolution')
     if not resolution:
         resolution = 500
@@ -719,7 +1099,7 @@ def grid():
     
     center = request.args.getlist('center[]')
     if not center:
-        center = [41.880517,-87.644061]
+        center = GRID_CENTER
     else:
         del raw_query_params['center[]']
     location_geom = request.args.get('location_geom__within')
@@ -729,17 +1109,7 @@ def grid():
 
     agg, datatype, queries = parse_join_query(raw_query_params)
 
-    size_x, size_y = getSizeInDegrees(float(resolution), float(center[0]))
-    if location_geom:
-        location_geom = json.loads(location_geom)['geometry']
-        if location_geom['type'] == 'LineString':
-            shape = asShape(location_geom)
-            lat = shape.centroid.y
-            # 100 meters by default
-            x, y = getSizeInDegrees(int(buff), lat)
-            size_x, size_y = getSizeInDegrees(50, lat)
-            location_geom = shape.buffer(y).__geo_interface__
-        location_geom['crs'] = {"type":"name","properties":{"name":"EPSG:4326"}}
+    size_x, size_y = grid_cell_size(resolution, center, location_geom)
     mt = MasterTable.__table__
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
 
@@ -747,11 +1117,24 @@ def grid():
         base_query = session.query(func.count(mt.c.dataset_row_id), 
                 func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y))
         dname = raw_query_params['dataset_name']
-        dataset = Table('dat_%s' % dname, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
+        dataset = registry.get_dataset_table(dname)
         valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
-        if valid_query:
+        grid_clauses = None
+        if float(resolution) in GRID_RESOLUTIONS and \
+            float(center[0]) == GRID_CENTER[0] and not location_geom:
+            grid_clauses = make_daily_query(dict(queries['base'], **queries['detail']), 
+                MasterGridCount.__table__)
+        if valid_query and grid_clauses is not None:
+            # No filters on the dataset's own columns or on location so 
+            # the precomputed grid counts can answer this
+            gt = MasterGridCount.__table__
+            base_query = session.query(cast(func.sum(gt.c.obs_count), BigInteger), 
+                gt.c.x, gt.c.y)
+            base_query = base_query.filter(gt.c.resolution == int(float(resolution)))
+            for clause in grid_clauses:
+                base_query = base_query.filter(clause)
+            cells = [c for c in base_query.group_by(gt.c.x, gt.c.y).all()]
+        elif valid_query:
             pk = [p.name for p in dataset.primary_key][0]
             base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
             for clause in base_clauses:
@@ -760,31 +1143,271 @@ def grid():
                 base_query = base_query.filter(clause)
 
             base_query = base_query.group_by(func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y))
-            values = [d for d in base_query.all()]
-            resp = {'type': 'FeatureCollection', 'features': []}
-            for value in values:
-                d = {
-                    'type': 'Feature', 
-                    'properties': {
-                        'count': value[0], 
-                    },
-                }
+            check_query_cost(base_query)
+            cells = []
+            for value in base_query.all():
                 if value[1]:
                     pt = loads(value[1].decode('hex'))
-                    south, west = (pt.x - (size_x / 2)), (pt.y - (size_y /2))
-                    north, east = (pt.x + (size_x / 2)), (pt.y + (size_y / 2))
-                    d['geometry'] = box(south, west, north, east).__geo_interface__
-                
-                resp['features'].append(d)
+                    cells.append((value[0], pt.x, pt.y))
+                else:
+                    cells.append((value[0], None, None))
+        if valid_query:
+            resp = grid_features(cells, size_x, size_y)
     
     resp = make_response(json.dumps(resp, default=dthandler), status_code)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+@api.route(API_VERSION + '/api/tiles/<dataset_name>/<int:z>/<int:x>/<int:y>.mvt')
+@conditional
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
+@crossdomain(origin="*")
+def tiles(dataset_name, z, x, y):
+    """ 
+    Mapbox Vector Tile with the records of a dataset that fall in tile 
+    z/x/y. Takes the same filters as /detail. When a 'resolution' is 
+    given, the tile has the cells of /grid (with a 'count' property) 
+    instead of the individual records.
+    """
+    raw_query_params = request.args.copy()
+    raw_query_params['dataset_name'] = dataset_name
+
+    # if no obs_date given, default to >= 30 days ago
+    obs_dates = [i for i in raw_query_params.keys() if i.startswith('obs_date')]
+    if not obs_dates:
+        six_months_ago = datetime.now() - timedelta(days=30)
+        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
+
+    resolution = raw_query_params.get('resolution')
+    if resolution:
+        del raw_query_params['resolution']
+    center = request.args.getlist('center[]')
+    if not center:
+        center = GRID_CENTER
+    else:
+        del raw_query_params['center[]']
+
+    agg, datatype, queries = parse_join_query(raw_query_params)
+    mt = MasterTable.__table__
+    valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
+    if x >= 2 ** z or y >= 2 ** z:
+        valid_query = False
+        resp['meta']['message'] = "'%s/%s/%s' is not a valid tile" % (z, x, y)
+        status_code = 400
+    if valid_query:
+        try:
+            dataset = registry.get_dataset_table(dataset_name)
+            valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
+        except NoSuchTableError:
+            valid_query = False
+            resp['meta']['message'] = "unable to find dataset '%s'" % dataset_name
+            status_code = 400
+    if not valid_query:
+        resp = make_response(json.dumps(resp, default=dthandler), status_code)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    envelope = func.ST_MakeEnvelope(minx, miny, maxx, maxy, 3857)
+    bounds = func.ST_MakeBox2D(func.ST_Point(minx, miny), func.ST_Point(maxx, maxy))
+    if resolution:
+        # Same cells as /grid, drawn as boxes
+        size_x, size_y = getSizeInDegrees(float(resolution), float(center[0]))
+        cell = func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y)
+        geom = func.ST_AsMVTGeom(
+            func.ST_Transform(func.ST_Expand(cell, size_x / 2, size_y / 2), 3857), 
+            bounds)
+        base_query = session.query(geom.label('geom'), 
+            func.count(mt.c.dataset_row_id).label('count'))
+    else:
+        geom = func.ST_AsMVTGeom(func.ST_Transform(mt.c.location_geom, 3857), bounds)
+        base_query = session.query(geom.label('geom'), 
+            mt.c.dataset_row_id, mt.c.obs_date)
+    pk = [p.name for p in dataset.primary_key][0]
+    base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
+    base_query = base_query.filter(
+        mt.c.location_geom.intersects(func.ST_Transform(envelope, 4326)))
+    for clause in base_clauses:
+        base_query = base_query.filter(clause)
+    for clause in detail_clauses:
+        base_query = base_query.filter(clause)
+    if resolution:
+        base_query = base_query.group_by(cell)
+    check_query_cost(base_query)
+    rows = base_query.subquery('q')
+    tile = session.query(func.ST_AsMVT(text('q'), dataset_name, 4096, 'geom'))\
+        .select_from(rows).scalar()
+
+    resp = make_response(str(tile or ''), 200)
+    resp.headers['Content-Type'] = 'application/vnd.mapbox-vector-tile'
+    return resp
+
+@api.route(API_VERSION + '/api/batch/', methods=['POST', 'OPTIONS'])
+@compressed
+@crossdomain(origin="*", headers=['Content-Type'])
+def batch():
+    """ 
+    Answers several /timeseries, /detail-aggregate and /grid queries in 
+    one request. The body is JSON like
+
+    {"queries": [{"endpoint": "grid", "params": {"dataset_name": ...}}, ...]}
+
+    where 'params' are the query string params the endpoint takes. 
+    Sub-queries that filter the same rows of the same dataset share one 
+    scan of dat_master (a CTE) and everything runs as a single statement.
+    Results come back in the same order as the queries, shaped like the
+    JSON each endpoint returns.
+    """
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': '',
+        },
+        'objects': [],
+    }
+    body = request.get_json(force=True, silent=True)
+    subqueries = None
+    if isinstance(body, dict):
+        subqueries = body.get('queries')
+    if not isinstance(subqueries, list) or not subqueries:
+        resp['meta']['message'] = "'queries' must be a list of sub-queries"
+        return make_batch_response(resp, 400)
+    if len(subqueries) > MAX_BATCH_QUERIES:
+        resp['meta']['message'] = "a batch can have at most %s queries" % MAX_BATCH_QUERIES
+        return make_batch_response(resp, 400)
+
+    plans = []
+    dataset_names = []
+    for i, subquery in enumerate(subqueries):
+        try:
+            plans.append(plan_batch_query(subquery, dataset_names))
+        except ValueError as e:
+            resp['meta']['message'] = 'query %s: %s' % (i, e)
+            return make_batch_response(resp, 400)
+
+    # One CTE per distinct set of filtered rows
+    shared_rows = {}
+    selects = []
+    for i, plan in enumerate(plans):
+        rows = None
+        if plan['rollup_clauses'] is None:
+            rows = shared_rows.get(plan['rows_key'])
+            if rows is None:
+                rows = make_batch_rows(plan, 'batch_rows_%s' % len(shared_rows))
+                shared_rows[plan['rows_key']] = rows
+        selects.append(make_batch_select(i, plan, rows))
+
+    batch_query = union_all(*selects)
+    if shared_rows:
+        check_query_cost(batch_query)
+    results = [[] for p in plans]
+    for r in session.execute(batch_query):
+        results[r.query].append(r)
+    for plan, rows in zip(plans, results):
+        resp['objects'].append(make_batch_result(plan, rows))
+    resp['meta']['status'] = 'ok'
+    resp['meta']['total'] = len(resp['objects'])
+    return make_batch_response(resp, 200)
+
+@api.route(API_VERSION + '/api/export/', methods=['POST'])
+@login_required
+def export():
+    """ 
+    Queues an export of every /detail row that matches the query (with 
+    no RESPONSE_LIMIT) as a gzipped CSV of the dataset's columns. The 
+    body is a JSON object of the params /detail takes. The export runs 
+    on a Celery worker, the response says where to check on it and where
+    to download it from (both GETs) once it is done. Files are kept for
+    EXPORT_RETENTION seconds (see plenario.tasks.expire_exports).
+
+    Starting an export is a side effect of a logged in user's session, so
+    it takes a POST with a JSON body (which other sites' pages can only 
+    send after a CORS preflight) and sends no CORS headers.
+    """
+    body = request.get_json(silent=True)
+    raw_query_params = MultiDict()
+    if isinstance(body, dict):
+        for k, v in body.items():
+            raw_query_params[k] = unicode(v)
+    agg, datatype, queries = parse_join_query(raw_query_params)
+    mt = MasterTable.__table__
+    valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
+    dname = raw_query_params.get('dataset_name')
+    if not isinstance(body, dict):
+        valid_query = False
+        resp['meta']['message'] = "the body must be a JSON object of /detail params"
+        status_code = 400
+    elif not dname:
+        valid_query = False
+        resp['meta']['message'] = "'dataset_name' is required"
+        status_code = 400
+    if valid_query:
+        try:
+            dataset = registry.get_dataset_table(dname)
+        except NoSuchTableError:
+            valid_query = False
+            resp['meta']['message'] = "unable to find dataset '%s'" % dname
+            status_code = 400
+    if valid_query:
+        valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
+    if valid_query:
+        pk = [p.name for p in dataset.primary_key][0]
+        query = select([dataset])\
+            .select_from(mt.join(dataset, mt.c.dataset_row_id == dataset.c[pk]))
+        for clause in base_clauses + detail_clauses:
+            query = query.where(clause)
+        check_query_cost(query)
+        job_id = EXPORT_JOB_PREFIX + str(uuid4())
+        # Celery says PENDING for ids it has never seen, so the job is
+        # marked before it is queued to tell it apart from made up ids
+        export_detail.backend.store_result(job_id, None, EXPORT_QUEUED)
+        export_detail.apply_async((literal_sql(query), dname), task_id=job_id)
+        resp['meta']['status'] = 'ok'
+        resp['meta']['query'] = raw_query_params
+        resp['objects'] = [export_job_info(job_id, EXPORT_QUEUED)]
+        status_code = 202
+    resp = make_response(json.dumps(resp, default=dthandler), status_code)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+@api.route(API_VERSION + '/api/export/<job_id>/')
+@crossdomain(origin="*")
+def export_status(job_id):
+    job = get_export_job(job_id)
+    resp = {
+        'meta': {
+            'status': 'ok',
+            'message': '',
+        },
+        'objects': [export_job_info(job_id, job.status)],
+    }
+    if job.status == 'FAILURE':
+        resp['meta']['message'] = str(job.result)
+    resp = make_response(json.dumps(resp, default=dthandler), 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+@api.route(API_VERSION + '/api/export/<job_id>/download/')
+@crossdomain(origin="*")
+def export_download(job_id):
+    job = get_export_job(job_id)
+    if job.status != 'SUCCESS':
+        abort(404)
+    location = job.result
+    if location.get('s3_key'):
+        s3conn = S3Connection(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        key = s3conn.get_bucket(S3_BUCKET).get_key(location['s3_key'])
+        if key is None:
+            abort(404)
+        return redirect(key.generate_url(EXPORT_URL_EXPIRES))
+    if not os.path.exists(location['path']):
+        abort(404)
+    return send_file(location['path'], mimetype='application/gzip', 
+        as_attachment=True, attachment_filename=location['filename'])
+
 # helper functions
 def make_query(table, raw_query_params):
-    table_keys = table.columns.keys()
-    args_keys = raw_query_params.keys()
     resp = {
         'meta': {
             'status': 'error',
@@ -796,58 +1419,90 @@ def make_query(table, raw_query_params):
     query_clauses = []
     valid_query = True
 
-    #print "make_query(): args_keys = ", args_keys
-    
-    if 'offset' in args_keys:
-        args_keys.remove('offset')
-    if 'limit' in args_keys:
-        args_keys.remove('limit')
-    if 'order_by' in args_keys:
-        args_keys.remove('order_by')
-    if 'weather' in args_keys:
-        args_keys.remove('weather')
-    for query_param in args_keys:
+    plan = get_filter_plan(table, raw_query_params.keys())
+    for query_param, action, column_name, arg in plan:
+        query_value = raw_query_params.get(query_param)
+        column = None
+        if column_name is not None:
+            column = table.columns[column_name]
+        if action == 'invalid_field':
+            resp['meta']['message'] = '"%s" is not a valid fieldname' % arg
+            status_code = 400
+            valid_query = False
+        elif action == 'invalid_operator':
+            resp['meta']['message'] = '"%s" is not a valid query operator' % arg
+            status_code = 400
+            valid_query = False
+            break
+        elif action == 'in':
+            query = column.in_(query_value.split(','))
+            query_clauses.append(query)
+        elif action == 'within':
+            query = make_within_clause(column, query_value)
+            query_clauses.append(query)
+        elif action == 'time_of_day':
+            query = getattr(func.date_part('hour', column), arg)(query_value)
+            query_clauses.append(query)
+        else:
+            if query_value == 'null': # pragma: no cover
+                query_value = None
+            query = getattr(column, arg)(query_value)
+            query_clauses.append(query)
+
+    if table is MasterTable.__table__:
+        # Records the ETL has replaced stay in dat_master with current_flag 
+        # off, only the current version of each one should be returned
+        query_clauses.append(table.c['current_flag'] == True)
+
+    return valid_query, query_clauses, resp, status_code
+
+def get_filter_plan(table, keys):
+    """ 
+    Returns the steps make_query takes to turn params with these 'keys' 
+    into clauses on 'table'. Working out the field, operator and column
+    method for each param is done the first time a table sees a set of
+    keys and reused after that, so only the values are bound per request.
+    Plans name their columns rather than hold them: a Column references
+    its table, which would keep the weak key alive for good.
+    """
+    shape = tuple(sorted(k for k in keys if k not in NON_FILTER_PARAMS))
+    with filter_plans_lock:
+        plans = filter_plans.get(table)
+        if plans is None:
+            plans = filter_plans[table] = {}
+        plan = plans.get(shape)
+    if plan is None:
+        plan = compile_filter_plan(table, shape)
+        with filter_plans_lock:
+            if len(plans) >= MAX_FILTER_PLANS:
+                plans.clear()
+            plans[shape] = plan
+    return plan
+
+def compile_filter_plan(table, shape):
+    """ 
+    Returns a (query_param, action, column_name, arg) step for each param
+    in 'shape'. 'arg' is the column method to call for comparisons and the
+    bad field or operator for invalid params.
+    """
+    plan = []
+    for query_param in shape:
         try:
             field, operator = query_param.split('__')
-            #print "make_query(): field, operator =", field, operator
         except ValueError:
             field = query_param
             operator = 'eq'
-        query_value = raw_query_params.get(query_param)
         column = table.columns.get(field)
-        if field not in table_keys:
-            resp['meta']['message'] = '"%s" is not a valid fieldname' % field
-            status_code = 400
-            valid_query = False
+        if column is None:
+            plan.append((query_param, 'invalid_field', None, field))
         elif operator == 'in':
-            query = column.in_(query_value.split(','))
-            query_clauses.append(query)
+            plan.append((query_param, 'in', field, None))
         elif operator == 'within':
-            geo = json.loads(query_value)
-            #print "make_query(): geo is", geo.items()
-            if 'features' in geo.keys():
-                val = geo['features'][0]['geometry']
-            elif 'geometry' in geo.keys():
-                val = geo['geometry']
-            else:
-                val = geo
-            if val['type'] == 'LineString':
-                shape = asShape(val)
-                lat = shape.centroid.y
-                # 100 meters by default
-                x, y = getSizeInDegrees(100, lat)
-                val = shape.buffer(y).__geo_interface__
-            val['crs'] = {"type":"name","properties":{"name":"EPSG:4326"}}
-            query = column.ST_Within(func.ST_GeomFromGeoJSON(json.dumps(val)))
-            #print "make_query: val=", val
-            #print "make_query(): query = ", query
-            query_clauses.append(query)
-        elif operator.startswith('time_of_day'):
-            if operator.endswith('ge'):
-                query = func.date_part('hour', column).__ge__(query_value)
-            elif operator.endswith('le'):
-                query = func.date_part('hour', column).__le__(query_value)
-            query_clauses.append(query)
+            plan.append((query_param, 'within', field, None))
+        elif operator.startswith('time_of_day') and operator.endswith('ge'):
+            plan.append((query_param, 'time_of_day', field, '__ge__'))
+        elif operator.startswith('time_of_day') and operator.endswith('le'):
+            plan.append((query_param, 'time_of_day', field, '__le__'))
         else:
             try:
                 attr = filter(
@@ -855,31 +1510,73 @@ def make_query(table, raw_query_params):
                     ['%s', '%s_', '__%s__']
                 )[0] % operator
             except IndexError:
-                resp['meta']['message'] = '"%s" is not a valid query operator' % operator
-                status_code = 400
-                valid_query = False
+                plan.append((query_param, 'invalid_operator', None, operator))
                 break
-            if query_value == 'null': # pragma: no cover
-                query_value = None
-            query = getattr(column, attr)(query_value)
-            query_clauses.append(query)
-
-    #print "make_query(): query_clauses=", query_clauses
-    return valid_query, query_clauses, resp, status_code
-
-def getSizeInDegrees(meters, latitude):
-
-    earth_circumference = 40041000.0 # meters, average circumference
-    degrees_per_meter = 360.0 / earth_circumference
-    
-    degrees_at_equator = meters * degrees_per_meter
-
-    latitude_correction = 1.0 / math.cos(latitude * (math.pi / 180.0))
-    
-    degrees_x = degrees_at_equator * latitude_correction
-    degrees_y = degrees_at_equator
-
-    return degrees_x, degrees_y
+            plan.append((query_param, 'compare', field, attr))
+    return plan
+
+def make_daily_query(raw_query_params, table=None):
+    """ 
+    Translates the filters of a /timeseries, /detail-aggregate or /grid
+    query into clauses on a table of daily counts (dat_master_daily 
+    unless another 'table' is given). Returns None when some filter can 
+    only be answered from dat_master (filters on a dataset's own columns,
+    location, times that are not on a day boundary, etc).
+    """
+    if table is not None:
+        dt = table
+    else:
+        dt = MasterDailyCount.__table__
+    query_clauses = []
+    for query_param, query_value in raw_query_params.items():
+        if query_param in ['offset', 'limit', 'order_by', 'weather', 'cursor']:
+            continue
+        try:
+            field, operator = query_param.split('__')
+        except ValueError:
+            field = query_param
+            operator = 'eq'
+        if field == 'dataset_name' and operator in ['eq', 'in']:
+            query_clauses.append(dt.c.dataset_name.in_(query_value.split(',')))
+        elif field == 'obs_date' and operator in ['ge', 'gt', 'le', 'lt']:
+            try:
+                d = parse(query_value)
+            except (ValueError, TypeError, OverflowError):
+                return None
+            if d.tzinfo or d.hour or d.minute or d.second or d.microsecond:
+                return None
+            d = d.date()
+            if operator == 'ge':
+                query_clauses.append(dt.c.obs_day >= d)
+            elif operator == 'lt':
+                query_clauses.append(dt.c.obs_day < d)
+            elif operator == 'le':
+                query_clauses.append(or_(dt.c.obs_day < d, 
+                    and_(dt.c.obs_day == d, dt.c.at_midnight == True)))
+            else:
+                query_clauses.append(or_(dt.c.obs_day > d, 
+                    and_(dt.c.obs_day == d, dt.c.at_midnight == False)))
+        elif field == 'census_block' and operator == 'like' and \
+            'census_tract' in dt.c:
+            # Only state, county and tract level prefixes are rolled up
+            tract = re.match(r'^(\d{1,11})%$', query_value)
+            if not tract:
+                return None
+            query_clauses.append(dt.c.census_tract.like('%s%%' % tract.group(1)))
+        else:
+            return None
+    return query_clauses
+
+def tile_bounds(z, x, y):
+    """ 
+    Returns the Web Mercator (EPSG:3857) bounds of tile z/x/y as 
+    (minx, miny, maxx, maxy)
+    """
+    world = 20037508.342789244
+    size = 2 * world / (2 ** z)
+    minx = -world + x * size
+    maxy = world - y * size
+    return minx, maxy - size, minx + size, maxy
 
 def make_csv(data):
     outp = StringIO()
@@ -887,6 +1584,265 @@ def make_csv(data):
     writer.writerows(data)
     return outp.getvalue()
 
+def make_cursor(sort_date, row_id):
+    """ 
+    Makes an opaque keyset pagination token pointing at the row 
+    identified by 'sort_date' and 'row_id'
+    """
+    return urlsafe_b64encode(json.dumps([sort_date.isoformat(), row_id]))
+
+def parse_cursor(token):
+    """ 
+    Returns the (sort_date, row_id) pair encoded in a token made by 
+    make_cursor. An empty token asks for the first page so (None, None) 
+    is returned. Raises ValueError for anything else.
+    """
+    if not token:
+        return None, None
+    try:
+        sort_date, row_id = json.loads(urlsafe_b64decode(str(token)))
+        return parse(sort_date), int(row_id)
+    except (TypeError, ValueError, AttributeError, OverflowError):
+        raise ValueError('Invalid cursor')
+
+def parse_precision(raw_query_params):
+    """ 
+    Returns the number of decimal places to keep in GeoJSON coordinates 
+    ('None' keeps the PostGIS default). Raises ValueError if the 
+    'precision' param is not a whole number from 0 to MAX_GEOJSON_PRECISION.
+    """
+    precision = raw_query_params.get('precision')
+    if precision is None:
+        return None
+    precision = int(precision)
+    if not 0 <= precision <= MAX_GEOJSON_PRECISION:
+        raise ValueError(precision)
+    return precision
+
+def geojson_column(geom_col, precision=None):
+    """ 
+    Has Postgres write out 'geom_col' as GeoJSON so rows don't need to 
+    be decoded with shapely. The column comes back as 'location_geojson'.
+    """
+    if precision is None:
+        geojson = func.ST_AsGeoJSON(geom_col)
+    else:
+        geojson = func.ST_AsGeoJSON(geom_col, precision)
+    return geojson.label('location_geojson')
+
+def splice_json(d, key, raw):
+    """ 
+    Dumps 'd' and adds 'key' to it with 'raw' (already a JSON string)
+    as its value, without parsing 'raw' again.
+    """
+    dumped = json.dumps(d, default=dthandler)
+    if raw is None:
+        return dumped
+    sep = ', ' if d else ''
+    return '%s%s"%s": %s}' % (dumped[:-1], sep, key, raw)
+
+def dump_detail_row(value, dataset_fields, weather_fields=None):
+    """ 
+    Returns one /detail row as a JSON string
+    """
+    if weather_fields:
+        d = {
+            'observation': {f:getattr(value, f) for f in dataset_fields},
+            'weather': {f:getattr(value, f) for f in weather_fields},
+        }
+        return json.dumps(d, default=dthandler)
+    d = {f:getattr(value, f) for f in dataset_fields}
+    return splice_json(d, 'location_geom', value.location_geojson)
+
+def dump_detail_feature(value, dataset_fields):
+    """ 
+    Returns one /detail row as a JSON encoded GeoJSON Feature
+    """
+    properties = {f:getattr(value, f) for f in dataset_fields}
+    return '{"type": "Feature", "geometry": %s, "properties": %s}' \
+        % (value.location_geojson, json.dumps(properties, default=dthandler))
+
+def stream_detail(values, datatype, resp, dataset_fields, weather_fields, dname,
+                  columns=None):
+    """ 
+    Returns a streaming response that writes out rows from 'values' 
+    (a query iterated with a server side cursor) as they are fetched 
+    instead of building the whole response body in memory.
+    """
+
+    def generate_json():
+        # 'total' is only known once all the rows have been written so
+        # the 'meta' block goes at the end of the response
+        yield '{"objects": ['
+        total = 0
+        for value in values:
+            if total:
+                yield ','
+            yield dump_detail_row(value, dataset_fields, weather_fields)
+            total += 1
+        resp['meta']['total'] = total
+        yield '], "meta": %s}' % json.dumps(resp['meta'], default=dthandler)
+
+    def generate_geojson():
+        yield '{"type": "FeatureCollection", "features": ['
+        first = True
+        for value in values:
+            if value.location_geojson is None:
+                continue
+            if not first:
+                yield ','
+            yield dump_detail_feature(value, dataset_fields)
+            first = False
+        yield ']}'
+
+    def generate_csv():
+        fields = dataset_fields
+        if weather_fields:
+            fields = dataset_fields + weather_fields
+        yield make_csv([fields])
+        for value in values:
+            yield make_csv([[getattr(value, f) for f in fields]])
+
+    if datatype == 'csv':
+        resp = Response(stream_with_context(generate_csv()), mimetype='text/csv')
+        filedate = datetime.now().strftime('%Y-%m-%d')
+        resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (dname, filedate)
+    elif datatype in COLUMNAR_DATA_TYPE:
+        resp = columnar_response(values, columns, datatype, dname, stream=True)
+    elif datatype == 'geojson' and not weather_fields:
+        resp = Response(stream_with_context(generate_geojson()), 
+            mimetype='application/json')
+    else:
+        resp = Response(stream_with_context(generate_json()), 
+            mimetype='application/json')
+    return resp
+
+class ColumnarSink(object):
+    """ 
+    Write only file for the pyarrow writers. Whatever has been written
+    since the last call to drain() is handed back by it so the output 
+    can be streamed a batch at a time.
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def to_text(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+def to_float(value):
+    return None if value is None else float(value)
+
+def arrow_field(column):
+    """ 
+    Returns the Arrow type for a reflected column and a function that 
+    turns its values into something pyarrow can take
+    """
+    t = column.type
+    keep = lambda v: v
+    if isinstance(t, Boolean):
+        return pyarrow.bool_(), keep
+    if isinstance(t, Integer):
+        return pyarrow.int64(), keep
+    if isinstance(t, Float):
+        return pyarrow.float64(), keep
+    if isinstance(t, Numeric):
+        return pyarrow.float64(), to_float
+    if isinstance(t, DateTime):
+        if t.timezone:
+            return pyarrow.timestamp('us', tz='UTC'), keep
+        return pyarrow.timestamp('us'), keep
+    if isinstance(t, Date):
+        return pyarrow.date32(), keep
+    if isinstance(t, Time):
+        return pyarrow.time64('us'), keep
+    return pyarrow.string(), to_text
+
+def generate_columnar(values, columns, datatype):
+    """ 
+    Writes 'values' out as an Arrow IPC stream or a Parquet file, one 
+    record batch (or row group) per STREAM_CHUNK_SIZE rows. Column types
+    come from the reflected 'columns' so nothing is written or parsed as 
+    text. Geometry columns are left out.
+    """
+    fields = [(c.name,) + arrow_field(c) for c in columns 
+              if not isinstance(c.type, Geometry)]
+    names = [f[0] for f in fields]
+    schema = pyarrow.schema([pyarrow.field(n, t) for n, t, convert in fields])
+    sink = ColumnarSink()
+    out = pyarrow.PythonFile(sink, mode='w')
+    if datatype == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(out, schema)
+    else:
+        writer = pyarrow.RecordBatchStreamWriter(out, schema)
+
+    def write(rows):
+        arrays = [pyarrow.array([convert(getattr(r, n)) for r in rows], type=t)
+                  for n, t, convert in fields]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, names)
+        if datatype == 'parquet':
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        return sink.drain()
+
+    rows = []
+    for value in values:
+        rows.append(value)
+        if len(rows) == STREAM_CHUNK_SIZE:
+            yield write(rows)
+            rows = []
+    if rows:
+        yield write(rows)
+    writer.close()
+    yield sink.drain()
+
+def columnar_response(values, columns, datatype, name, stream=False):
+    """ 
+    Returns 'values' as an Arrow or Parquet attachment, streamed when 
+    'values' is a query iterated with a server side cursor
+    """
+    if datatype == 'parquet':
+        mimetype, ext = 'application/vnd.apache.parquet', 'parquet'
+    else:
+        mimetype, ext = 'application/vnd.apache.arrow.stream', 'arrows'
+    body = generate_columnar(values, columns, datatype)
+    if stream:
+        resp = Response(stream_with_context(body), mimetype=mimetype)
+    else:
+        resp = make_response(''.join(body), 200)
+        resp.headers['Content-Type'] = mimetype
+    filedate = datetime.now().strftime('%Y-%m-%d')
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.%s' \
+        % (name, filedate, ext)
+    return resp
+
 def parse_join_query(params):
     queries = {
         'base' : {},
@@ -920,3 +1876,394 @@ def parse_join_query(params):
         else:
             queries['detail'][key] = value
     return agg, datatype, queries
+
+def set_default_dates(raw_query_params):
+    """ 
+    Counts the last 90 days when the query has no obs_date range
+    """
+    if not raw_query_params.get('obs_date__ge'):
+        six_months_ago = datetime.now() - timedelta(days=90)
+        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
+
+    if not raw_query_params.get('obs_date__le'):
+        raw_query_params['obs_date__le'] = datetime.now().strftime('%Y-%m-%d') 
+
+def approved_dataset_names():
+    q = '''
+        SELECT m.dataset_name
+        FROM meta_master AS m 
+        WHERE m.approved_status = 'true'
+        AND m.last_task_status = 'SUCCESS'
+    '''
+    with engine.begin() as c:
+        return [d[0] for d in c.execute(q)]
+
+def grid_cell_size(resolution, center, location_geom=None):
+    """ 
+    Returns the size in degrees of the /grid cells: 'resolution' meters
+    at the latitude of 'center', or 50 meters when the query is along a
+    LineString.
+    """
+    if location_geom:
+        line_latitude = parse_within_geometry(location_geom)['line_latitude']
+        if line_latitude is not None:
+            return getSizeInDegrees(50, line_latitude)
+    return getSizeInDegrees(float(resolution), float(center[0]))
+
+def grid_features(cells, size_x, size_y):
+    """ 
+    Turns (count, x, y) cells into the /grid FeatureCollection
+    """
+    resp = {'type': 'FeatureCollection', 'features': []}
+    for count, x, y in cells:
+        d = {
+            'type': 'Feature', 
+            'properties': {
+                'count': count, 
+            },
+        }
+        if x is not None:
+            south, west = (x - (size_x / 2)), (y - (size_y /2))
+            north, east = (x + (size_x / 2)), (y + (size_y / 2))
+            d['geometry'] = box(south, west, north, east).__geo_interface__
+        
+        resp['features'].append(d)
+    return resp
+
+def plan_batch_query(subquery, dataset_names):
+    """ 
+    Works out what one /batch sub-query counts and which rows it counts,
+    the same way its endpoint would. 'dataset_names' is filled with the
+    approved datasets the first time a /timeseries sub-query needs them.
+    Raises ValueError with a message for the client when the sub-query 
+    is not valid.
+    """
+    if not isinstance(subquery, dict):
+        raise ValueError('sub-queries must be objects')
+    endpoint = subquery.get('endpoint')
+    if endpoint not in BATCH_ENDPOINTS:
+        raise ValueError("'%s' can not be batched" % endpoint)
+    params = MultiDict()
+    for k, v in (subquery.get('params') or {}).items():
+        if isinstance(v, list):
+            params.setlist(k, [unicode(i) for i in v])
+        else:
+            params[k] = unicode(v)
+
+    mt = MasterTable.__table__
+    plan = {
+        'endpoint': endpoint, 
+        'agg': None, 
+        'dataset': None,
+        'rollup_clauses': None,
+    }
+    if endpoint == 'timeseries':
+        agg = params.pop('agg', None) or 'day'
+        params.pop('data_type', None)
+        set_default_dates(params)
+        if not dataset_names:
+            dataset_names.extend(approved_dataset_names())
+        params['dataset_name__in'] = ','.join(dataset_names)
+        filters = params.to_dict()
+        valid_query, clauses, resp, status_code = make_query(mt, params)
+        if not valid_query:
+            raise ValueError(resp['meta']['message'])
+        plan['rollup_clauses'] = make_daily_query(params)
+    else:
+        if endpoint == 'grid':
+            resolution = params.pop('resolution', None) or 500
+            center = params.poplist('center[]') or GRID_CENTER
+            params.pop('buffer', None)
+            location_geom = params.get('location_geom__within')
+            plan['size'] = grid_cell_size(resolution, center, location_geom)
+        agg, datatype, queries = parse_join_query(params)
+        if endpoint == 'detail-aggregate':
+            set_default_dates(params)
+        dname = params.get('dataset_name')
+        if not dname:
+            raise ValueError("'dataset_name' is required")
+        try:
+            dataset = registry.get_dataset_table(dname)
+        except NoSuchTableError:
+            raise ValueError("unable to find dataset '%s'" % dname)
+        filters = dict(queries['base'], **queries['detail'])
+        valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
+        if valid_query:
+            valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
+        if not valid_query:
+            raise ValueError(resp['meta']['message'])
+        clauses = base_clauses + detail_clauses
+        plan['dataset'] = dataset
+        if endpoint == 'detail-aggregate':
+            plan['rollup_clauses'] = make_daily_query(filters)
+        elif float(resolution) in GRID_RESOLUTIONS and \
+            float(center[0]) == GRID_CENTER[0] and not location_geom:
+            plan['resolution'] = int(float(resolution))
+            plan['rollup_clauses'] = make_daily_query(filters, MasterGridCount.__table__)
+    if endpoint != 'grid':
+        if agg not in VALID_AGG:
+            raise ValueError("'%s' is an invalid temporal aggregation" % agg)
+        plan['agg'] = agg
+        plan['from_date'] = truncate(parse(params['obs_date__ge']), agg)
+        plan['to_date'] = parse(params['obs_date__le'])
+    plan['params'] = params.to_dict()
+    plan['clauses'] = clauses
+    plan['rows_key'] = (endpoint == 'timeseries', plan['dataset'] is not None and \
+        plan['dataset'].name, tuple(sorted((k, normalize_query_value(k, v)) \
+            for k, v in filters.items())))
+    return plan
+
+def make_batch_rows(plan, name):
+    """ 
+    Returns a CTE of the dat_master rows that 'plan' filters on
+    """
+    mt = MasterTable.__table__
+    rows = select([mt.c.dataset_name, mt.c.obs_date, mt.c.location_geom, 
+        mt.c.dataset_row_id])
+    dataset = plan['dataset']
+    if dataset is not None:
+        pk = [p.name for p in dataset.primary_key][0]
+        rows = rows.select_from(mt.join(dataset, mt.c.dataset_row_id == dataset.c[pk]))
+    for clause in plan['clauses']:
+        rows = rows.where(clause)
+    return rows.cte(name)
+
+def make_batch_select(index, plan, rows=None):
+    """ 
+    Returns the aggregate for one /batch sub-query, counted either off 
+    the shared 'rows' CTE or off the rollup tables. Every sub-query 
+    returns the same columns so they can be unioned together: 
+    (query, dataset_name, bucket, x, y, count)
+    """
+    query = literal(index).label('query')
+    no_name = cast(null(), String).label('dataset_name')
+    no_bucket = cast(null(), TIMESTAMP).label('bucket')
+    no_x = cast(null(), DOUBLE_PRECISION).label('x')
+    no_y = cast(null(), DOUBLE_PRECISION).label('y')
+    if plan['endpoint'] == 'grid' and rows is None:
+        gt = MasterGridCount.__table__
+        s = select([query, no_name, no_bucket, gt.c.x, gt.c.y, 
+                cast(func.sum(gt.c.obs_count), BigInteger).label('obs_count')])\
+            .where(gt.c.resolution == plan['resolution'])
+        for clause in plan['rollup_clauses']:
+            s = s.where(clause)
+        return s.group_by(gt.c.x, gt.c.y)
+    elif plan['endpoint'] == 'grid':
+        size_x, size_y = plan['size']
+        snap = func.ST_SnapToGrid(rows.c.location_geom, size_x, size_y)
+        return select([query, no_name, no_bucket, func.ST_X(snap).label('x'), 
+                func.ST_Y(snap).label('y'), 
+                func.count(rows.c.dataset_row_id).label('obs_count')])\
+            .group_by(snap)
+    elif rows is None:
+        dt = MasterDailyCount.__table__
+        bucket = func.date_trunc(plan['agg'], cast(dt.c.obs_day, TIMESTAMP))
+        count = cast(func.sum(dt.c.obs_count), BigInteger)
+        name = dt.c.dataset_name
+        where = plan['rollup_clauses']
+    else:
+        bucket = func.date_trunc(plan['agg'], rows.c.obs_date)
+        count = func.count(rows.c.obs_date)
+        if plan['endpoint'] == 'detail-aggregate':
+            count = func.count(rows.c.dataset_row_id)
+        name = rows.c.dataset_name
+        where = []
+    if plan['endpoint'] == 'timeseries':
+        s = select([query, name.label('dataset_name'), bucket.label('bucket'), 
+            no_x, no_y, count.label('obs_count')]).group_by(name, bucket)
+    else:
+        s = select([query, no_name, bucket.label('bucket'), no_x, no_y, 
+            count.label('obs_count')]).group_by(bucket)
+    for clause in where:
+        s = s.where(clause)
+    return s
+
+def make_batch_result(plan, rows):
+    """ 
+    Builds the response of one /batch sub-query from its rows
+    """
+    if plan['endpoint'] == 'grid':
+        size_x, size_y = plan['size']
+        return grid_features([(r.obs_count, r.x, r.y) for r in rows], size_x, size_y)
+    query = dict(plan['params'])
+    loc = query.get('location_geom__within')
+    if loc:
+        query['location_geom__within'] = json.loads(loc)
+    query['agg'] = plan['agg']
+    resp = {
+        'meta': {
+            'status': 'ok',
+            'message': '',
+            'query': query,
+        },
+        'objects': [],
+    }
+    buckets = datetime_aggregate_range(plan['from_date'], plan['to_date'], plan['agg'])
+    if plan['endpoint'] == 'timeseries':
+        rows = sorted(rows, key=lambda r: r.dataset_name)
+        for k, g in groupby(rows, key=lambda r: r.dataset_name):
+            d = {'dataset_name': k}
+            d['items'] = fill_datetime_aggregate(buckets, [(r.bucket, r.obs_count) for r in g])
+            resp['objects'].append(d)
+    else:
+        resp['objects'] = fill_datetime_aggregate(buckets, [(r.bucket, r.obs_count) for r in rows])
+    return resp
+
+def make_batch_response(resp, status_code):
+    resp = make_response(json.dumps(resp, default=dthandler), status_code)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+def literal_sql(statement):
+    """ 
+    Renders 'statement' with its params filled in (quoted by psycopg2)
+    for use inside COPY, which can't take bind params
+    """
+    compiled = statement.compile(dialect=engine.dialect)
+    conn = engine.raw_connection()
+    try:
+        return conn.cursor().mogrify(unicode(compiled), compiled.params)
+    finally:
+        conn.close()
+
+def get_export_job(job_id):
+    """ 
+    Returns the AsyncResult of export job 'job_id', or aborts with a 404
+    when the id is not one /export handed out
+    """
+    if not job_id.startswith(EXPORT_JOB_PREFIX):
+        abort(404)
+    job = export_detail.AsyncResult(job_id)
+    if job.status == 'PENDING':
+        abort(404)
+    return job
+
+def export_job_info(job_id, status):
+    d = {
+        'job_id': job_id,
+        'status': status,
+        'status_url': '%s/api/export/%s/' % (API_VERSION, job_id),
+    }
+    if status == 'SUCCESS':
+        d['download_url'] = '%s/api/export/%s/download/' % (API_VERSION, job_id)
+    return d
+
+def check_query_cost(query):
+    """ 
+    Runs EXPLAIN on 'query' (a Query or a select) and raises 
+    QueryTooExpensive when Postgres estimates that it costs more than
+    QUERY_COST_LIMIT, before any rows are read.
+    """
+    if not QUERY_COST_LIMIT:
+        return
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=engine.dialect)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % unicode(compiled), 
+            compiled.params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    if plan['Total Cost'] > QUERY_COST_LIMIT:
+        relation, rows = largest_scan(plan)
+        raise QueryTooExpensive(plan['Total Cost'], relation, rows)
+
+def largest_scan(plan):
+    """ 
+    Returns the table and estimated row count of the scan in 'plan' 
+    (an EXPLAIN node) that reads the most rows
+    """
+    relation, rows = plan.get('Relation Name'), plan.get('Plan Rows', 0)
+    if relation is None:
+        rows = 0
+    for subplan in plan.get('Plans', []):
+        sub_relation, sub_rows = largest_scan(subplan)
+        if sub_relation is not None and sub_rows > rows:
+            relation, rows = sub_relation, sub_rows
+    return relation, rows
+
+def parse_within_geometry(query_value):
+    """ 
+    Prepares a location_geom__within value (a GeoJSON geometry, Feature
+    or FeatureCollection) for filtering. LineStrings are buffered by 100
+    meters and polygons with more than SIMPLIFY_VERTICES vertices are 
+    simplified. Returns a dict with the geometry as GeoJSON, its bounding
+    box and vertex count and, for LineStrings, the latitude of the line.
+    Results are cached by a hash of 'query_value' so repeated queries 
+    skip the shapely work.
+    """
+    if isinstance(query_value, unicode):
+        query_value = query_value.encode('utf-8')
+    key = sha1(query_value).hexdigest()
+    with geometry_cache_lock:
+        prepared = geometry_cache.pop(key, None)
+        if prepared is not None:
+            geometry_cache[key] = prepared
+            return prepared
+
+    geo = json.loads(query_value)
+    if 'features' in geo.keys():
+        val = geo['features'][0]['geometry']
+    elif 'geometry' in geo.keys():
+        val = geo['geometry']
+    else:
+        val = geo
+    shape = asShape(val)
+    line_latitude = None
+    if val['type'] == 'LineString':
+        line_latitude = shape.centroid.y
+        # 100 meters by default
+        x, y = getSizeInDegrees(100, line_latitude)
+        shape = shape.buffer(y)
+        val = mapping(shape)
+    vertices = count_vertices(shape)
+    if vertices > SIMPLIFY_VERTICES:
+        shape = shape.simplify(SIMPLIFY_TOLERANCE, preserve_topology=True)
+        vertices = count_vertices(shape)
+        val = mapping(shape)
+    val = dict(val)
+    val['crs'] = {"type":"name","properties":{"name":"EPSG:4326"}}
+    prepared = {
+        'geojson': json.dumps(val),
+        'bbox': shape.bounds,
+        'vertices': vertices,
+        'line_latitude': line_latitude,
+    }
+    with geometry_cache_lock:
+        geometry_cache[key] = prepared
+        while len(geometry_cache) > GEOMETRY_CACHE_SIZE:
+            geometry_cache.popitem(last=False)
+    return prepared
+
+def count_vertices(shape):
+    if hasattr(shape, 'geoms'):
+        return sum(count_vertices(g) for g in shape.geoms)
+    if hasattr(shape, 'exterior'):
+        return len(shape.exterior.coords) + \
+            sum(len(i.coords) for i in shape.interiors)
+    return len(shape.coords)
+
+def make_within_clause(column, query_value):
+    """ 
+    Filters 'column' to the location_geom__within geometry. A bounding 
+    box test ('&&') goes first so the spatial index throws out most rows
+    before the exact test. Geometries with more than SUBDIVIDE_VERTICES
+    vertices are cut into small pieces with ST_Subdivide so each exact 
+    test only looks at the few vertices near the point.
+    """
+    prepared = parse_within_geometry(query_value)
+    geom = func.ST_GeomFromGeoJSON(prepared['geojson'])
+    minx, miny, maxx, maxy = prepared['bbox']
+    bbox = column.op('&&')(func.ST_MakeEnvelope(minx, miny, maxx, maxy, 4326))
+    if prepared['vertices'] <= SUBDIVIDE_VERTICES:
+        return and_(bbox, column.ST_Within(geom))
+    pieces = func.ST_Subdivide(geom, SUBDIVIDE_VERTICES).alias('piece')
+    piece = literal_column('piece')
+    in_piece = select([literal(1)]).select_from(pieces)\
+        .where(func.ST_Intersects(column, piece))\
+        .correlate(column.table)
+    return and_(bbox, exists(in_piece))
@@ -59,4 +59,7 @@ def init_db(no_create=False):
     print 'this will *also* take a few minutes ...'
     shp = PlenarioShapeETL(plenario.settings.CENSUS_BLOCKS)
     shp.add()
+
+    print 'matching census blocks to their nearest weather stations'
+    s.map_census_blocks()
     
@@ -1,6 +1,6 @@
 import os
 from sqlalchemy import Column, Integer, String, Boolean, Table, Date, DateTime, \
-    Float, Numeric, Text, TypeDecorator, BigInteger
+    Float, Numeric, Text, TypeDecorator, BigInteger, Index
 from sqlalchemy.dialects.postgresql import TIMESTAMP, DOUBLE_PRECISION, TIME,\
     DATE, ARRAY
 from geoalchemy2 import Geometry
@@ -42,6 +42,14 @@ class MetaTable(Base):
     contributed_data_types = Column(Text) # Temporarily store user-submitted data types for later approval
     is_socrata_source = Column(Boolean, default=False)
     result_ids = Column(ARRAY(String))
+    # Status of the most recent add_dataset or update_dataset task, 
+    # kept in step with celery_taskmeta by plenario.tasks
+    last_task_status = Column(String)
+    # Fingerprint of the source as of its last load, lets 
+    # PlenarioETL.update skip sources that haven't changed
+    source_etag = Column(String)
+    source_last_modified = Column(String)
+    source_hash = Column(String(40))
 
     def __repr__(self):
         return '<MetaTable %r (%r)>' % (self.human_name, self.dataset_name)
@@ -66,9 +74,71 @@ class MasterTable(Base):
     dataset_row_id = Column(Integer)
     location_geom = Column(Geometry('POINT', srid=4326))
 
+    # Supports keyset pagination of /detail (see api.parse_cursor), which
+    # always pages through a single dataset
+    __table_args__ = (
+        Index('ix_dat_master_dataset_name_obs_date_master_row_id', 
+            'dataset_name', 'obs_date', 'master_row_id'),
+    )
+
     def __repr__(self):
         return '<Master %r (%r)>' % (self.dataset_row_id, self.dataset_name)
 
+class MasterDailyCount(Base):
+    """ 
+    Daily counts of the current records in dat_master per dataset and 
+    census tract (the first 11 digits of the census block). 'at_midnight'
+    splits out records observed at exactly 00:00 so that obs_date 
+    filters on day boundaries can be answered exactly.
+    """
+    __tablename__ = 'dat_master_daily'
+    dataset_name = Column(String(100), primary_key=True)
+    obs_day = Column(Date, primary_key=True)
+    at_midnight = Column(Boolean, primary_key=True)
+    census_tract = Column(String(11), primary_key=True)
+    obs_count = Column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return '<MasterDailyCount %r (%r)>' % (self.dataset_name, self.obs_day)
+
+class MasterGridCount(Base):
+    """ 
+    Counts of the current records in dat_master per dataset and day in 
+    each cell of ST_SnapToGrid at the resolutions in 
+    plenario.utils.helpers.GRID_RESOLUTIONS. 'x' and 'y' are the snapped
+    point (NULL for records without a location).
+    """
+    __tablename__ = 'dat_master_grid'
+    id = Column(BigInteger, primary_key=True)
+    dataset_name = Column(String(100), nullable=False)
+    obs_day = Column(Date, nullable=False)
+    at_midnight = Column(Boolean, nullable=False)
+    resolution = Column(Integer, nullable=False)
+    x = Column(DOUBLE_PRECISION(precision=53))
+    y = Column(DOUBLE_PRECISION(precision=53))
+    obs_count = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index('ix_dat_master_grid_lookup', 'dataset_name', 'resolution', 'obs_day'),
+    )
+
+    def __repr__(self):
+        return '<MasterGridCount %r (%r)>' % (self.dataset_name, self.obs_day)
+
+class CensusBlockWeatherStation(Base):
+    """ 
+    The weather station nearest to each census block, so that records 
+    can be matched up with weather observations by census_block instead
+    of a nearest neighbor search per record. Built by
+    plenario.utils.weather.WeatherStationsETL.map_census_blocks.
+    """
+    __tablename__ = 'census_block_weather_stations'
+    geoid10 = Column(String(15), primary_key=True)
+    wban_code = Column(String(5), nullable=False)
+
+    def __repr__(self):
+        return '<CensusBlockWeatherStation %r (%r)>' % (self.geoid10, self.wban_code)
+
 def get_uuid():
     return unicode(uuid4())
 
@@ -0,0 +1,86 @@
+import time
+from threading import Lock
+from sqlalchemy import MetaData, Table, text
+
+from plenario.database import app_engine
+
+VERSION_TTL = 60
+
+class SchemaRegistry(object):
+    """
+    Process wide cache of reflected tables so that API requests don't need
+    to run the catalog queries behind autoload on every call. Tables are
+    reflected into the registry's own MetaData (not Base.metadata) the
+    first time they are asked for and kept until their version changes.
+
+    The version of a 'dat_<dataset_name>' table is the last_update stamp
+    and last_task_status of its row in meta_master. PlenarioETL bumps 
+    the stamp every time it loads the dataset, the status changes when
+    the task that loaded it finishes and the row goes away when the 
+    dataset is deleted.
+    Versions are read in a single query and refreshed at most every
+    'ttl' seconds. Tables that don't belong to a dataset (weather
+    observations, weather stations) are created with a fixed schema by
+    WeatherETL and WeatherStationsETL so they are kept once reflected.
+    Missing tables are never cached. Datasets are loaded by Celery 
+    workers, not the processes that answer API requests, so the version
+    stamp is how a change reaches the registry: it shows up within 'ttl'
+    seconds of update_last_task_status recording the task's final state.
+    """
+
+    def __init__(self, engine, ttl=VERSION_TTL):
+        self.engine = engine
+        self.ttl = ttl
+        self.metadata = MetaData()
+        self._tables = {}
+        self._versions = {}
+        self._versions_fetched = None
+        self._lock = Lock()
+
+    def get_table(self, table_name, version=None):
+        """
+        Returns the reflected Table for 'table_name', reflecting it if it
+        has not been seen yet or if its cached version differs from
+        'version'. Raises NoSuchTableError if the table does not exist.
+        """
+        with self._lock:
+            cached = self._tables.get(table_name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            if cached is not None:
+                self.metadata.remove(cached[1])
+                del self._tables[table_name]
+            table = Table(table_name, self.metadata,
+                autoload=True, autoload_with=self.engine)
+            self._tables[table_name] = (version, table)
+            return table
+
+    def get_dataset_table(self, dataset_name):
+        """
+        Returns the reflected 'dat_<dataset_name>' table
+        """
+        return self.get_table('dat_%s' % dataset_name,
+            self.dataset_version(dataset_name))
+
+    def dataset_version(self, dataset_name):
+        return self.dataset_versions().get(dataset_name)
+
+    def dataset_versions(self):
+        """
+        Returns a dict mapping each dataset_name to its version stamp
+        """
+        now = time.time()
+        if self._versions_fetched is None or \
+            now - self._versions_fetched > self.ttl:
+            q = text('''
+                SELECT dataset_name, last_update, last_task_status 
+                FROM meta_master
+            ''')
+            with self.engine.begin() as c:
+                versions = {r.dataset_name: (r.last_update, r.last_task_status) 
+                            for r in c.execute(q)}
+            self._versions = versions
+            self._versions_fetched = now
+        return self._versions
+
+registry = SchemaRegistry(app_engine)
@@ -0,0 +1,71 @@
+SECRET_KEY = 'abcdefghijklmnop'
+PLENARIO_SENTRY_URL = ''
+CELERY_SENTRY_URL = ''
+DATABASE_CONN = 'postgresql://plenario:@localhost:5432/plenario_dev'
+DATA_DIR = '/tmp'
+
+# See: https://pythonhosted.org/Flask-Cache/#configuring-flask-cache
+# for config options
+CACHE_CONFIG = {
+    'CACHE_TYPE': 'simple',
+}
+
+AWS_ACCESS_KEY = ''
+AWS_SECRET_KEY = ''
+S3_BUCKET = ''
+
+# Optional dict with attributes for a default web admin 
+DEFAULT_USER = {
+    'name': 'plenario_user',
+    'email': 'youremail@example.com',
+    'password': 'your password'
+}
+
+# Email address for notifying site administrators
+ADMIN_EMAIL = ''
+
+# For emailing users. ('MAIL_USERNAME' is an email address.)
+MAIL_SERVER = 'smtp.gmail.com'
+MAIL_PORT = 587
+MAIL_USE_TLS = True
+MAIL_DISPLAY_NAME = 'Plenar.io Team'
+MAIL_USERNAME = ''
+MAIL_PASSWORD = ''
+
+
+CENSUS_BLOCKS = {
+    'dataset_name': 'census_blocks',
+    'business_key': 'geoid',
+    'source_url': 'http://www2.census.gov/geo/tiger/TIGER2010/TABBLOCK/2010/tl_2010_17031_tabblock10.zip'
+}
+
+# Toggle maintenence mode
+MAINTENANCE = False
+
+# API queries are run through EXPLAIN first and turned away when Postgres
+# estimates they would cost more than this. Set to 0 to skip the check.
+QUERY_COST_LIMIT = 10000000
+
+# Longest (in milliseconds) a single query can run for, by API endpoint
+# (view function name). 'default' covers the endpoints not listed.
+STATEMENT_TIMEOUTS = {
+    'default': 30000,
+    'detail': 60000,
+    'batch': 60000,
+}
+
+# Requests that take longer than this many milliseconds are logged to the
+# 'plenario.slow_requests' logger. Counters for every endpoint are at
+# /v1/api/_stats.
+SLOW_REQUEST_MS = 2000
+
+# Rows (besides the first 1000) checked when guessing the column types of
+# a new dataset that was added without them, as a random sample from the
+# whole file. None checks every row. A sample (e.g. 100000) makes large
+# files much faster to add, but a value outside it that doesn't fit the
+# guessed type makes the dataset's load fail.
+TYPE_INFERENCE_SAMPLE = None
+
+# Seconds /v1/api/export/ files are kept (in DATA_DIR/exports or on S3)
+# before the expire_exports task deletes them
+EXPORT_RETENTION = 60*60*24
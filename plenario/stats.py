@@ -0,0 +1,156 @@
+import time
+import logging
+from datetime import datetime
+from threading import Lock
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from plenario.database import app_engine
+
+# Upper bounds (in milliseconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# Most distinct SQL statements to keep timings for
+MAX_STATEMENTS = 500
+
+slow_log = logging.getLogger('plenario.slow_requests')
+
+class RequestStats(object):
+    """
+    Counters for the requests this process has answered: latency per
+    endpoint (as a histogram), time spent in SQL and number of
+    statements (from engine events on app_engine), cache hits and misses,
+    time spent in the view outside of SQL (mostly building and
+    serializing the response) and time spent compressing. SQL time is
+    also kept per statement so slow query shapes stand out. Requests
+    slower than SLOW_REQUEST_MS (when set) are logged to
+    'plenario.slow_requests'.
+
+    The api blueprint marks cache lookups and view runs on flask.g
+    ('cache_checked', 'view_ms', 'compress_ms'); everything else is
+    collected here. Counters are per process.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.slow_request_ms = None
+        self.reset()
+
+    def init_app(self, app, engine=app_engine):
+        self.slow_request_ms = app.config.get('SLOW_REQUEST_MS')
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.statements = {}
+            self.since = datetime.now()
+
+    def snapshot(self):
+        """
+        Returns the counters as a dict that can be dumped to JSON
+        """
+        with self._lock:
+            endpoints = {}
+            for name, e in self.endpoints.items():
+                e = dict(e)
+                e['statuses'] = dict(e['statuses'])
+                e['mean_ms'] = e['total_ms'] / e['requests']
+                labels = ['le_%s' % b for b in LATENCY_BUCKETS] + \
+                    ['gt_%s' % LATENCY_BUCKETS[-1]]
+                e['histogram'] = dict(zip(labels, e['histogram']))
+                endpoints[name] = e
+            statements = sorted(
+                [{'statement': k, 'count': v[0], 'total_ms': v[1]}
+                    for k, v in self.statements.items()],
+                key=lambda s: s['total_ms'], reverse=True)
+            return {
+                'since': self.since,
+                'endpoints': endpoints,
+                'statements': statements[:50],
+            }
+
+    def _start_request(self):
+        g.stats_start = time.time()
+        g.sql_ms = 0.0
+        g.sql_statements = 0
+
+    def _finish_request(self, response):
+        start = getattr(g, 'stats_start', None)
+        if start is None:
+            return response
+        elapsed_ms = (time.time() - start) * 1000
+        endpoint = request.endpoint or 'unknown'
+        view_ms = getattr(g, 'view_ms', None)
+        with self._lock:
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = {
+                    'requests': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                    'sql_ms': 0.0,
+                    'sql_statements': 0,
+                    'cache_hits': 0,
+                    'cache_misses': 0,
+                    'python_ms': 0.0,
+                    'compress_ms': 0.0,
+                    'statuses': {},
+                }
+            e['requests'] += 1
+            e['total_ms'] += elapsed_ms
+            e['max_ms'] = max(e['max_ms'], elapsed_ms)
+            bucket = len(LATENCY_BUCKETS)
+            for i, upper in enumerate(LATENCY_BUCKETS):
+                if elapsed_ms <= upper:
+                    bucket = i
+                    break
+            e['histogram'][bucket] += 1
+            e['sql_ms'] += g.sql_ms
+            e['sql_statements'] += g.sql_statements
+            if getattr(g, 'cache_checked', False):
+                if view_ms is None:
+                    e['cache_hits'] += 1
+                else:
+                    e['cache_misses'] += 1
+            if view_ms is not None:
+                e['python_ms'] += max(view_ms - g.sql_ms, 0)
+            e['compress_ms'] += getattr(g, 'compress_ms', 0.0)
+            status = str(response.status_code)
+            e['statuses'][status] = e['statuses'].get(status, 0) + 1
+        if self.slow_request_ms and elapsed_ms >= self.slow_request_ms:
+            slow_log.warning('%s %s took %dms (%d statements, %dms in SQL)',
+                request.method, request.full_path, elapsed_ms,
+                g.sql_statements, g.sql_ms)
+        return response
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # The start goes on the statement's own execution context: a
+        # statement that fails (a statement_timeout, say) never gets an
+        # after_cursor_execute, and its start has to go away with it
+        if has_request_context() and context is not None:
+            context._stats_start = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        start = getattr(context, '_stats_start', None)
+        if not has_request_context() or start is None:
+            return
+        elapsed_ms = (time.time() - start) * 1000
+        if getattr(g, 'stats_start', None) is not None:
+            g.sql_ms += elapsed_ms
+            g.sql_statements += 1
+        with self._lock:
+            s = self.statements.get(statement)
+            if s is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    return
+                s = self.statements[statement] = [0, 0.0]
+            s[0] += 1
+            s[1] += elapsed_ms
+
+stats = RequestStats()
@@ -1,17 +1,26 @@
 import os
+import gzip
 from urlparse import urlparse
 from plenario.celery_app import celery_app
-from plenario.models import MetaTable, MasterTable
+from plenario.models import MetaTable, MasterTable, MasterDailyCount, \
+    MasterGridCount
 from plenario.database import task_session as session, task_engine as engine, \
     Base
 from plenario.utils.etl import PlenarioETL
 from plenario.utils.weather import WeatherETL
 from raven.handlers.logging import SentryHandler
 from raven.conf import setup_logging
-from plenario.settings import CELERY_SENTRY_URL
+from plenario.settings import CELERY_SENTRY_URL, DATA_DIR, AWS_ACCESS_KEY, \
+    AWS_SECRET_KEY, S3_BUCKET, EXPORT_RETENTION
+from boto.s3.connection import S3Connection
+from boto.s3.key import Key
+from boto.utils import parse_ts
 from sqlalchemy import Table
 from sqlalchemy.exc import NoSuchTableError, InternalError
 from datetime import datetime, timedelta
+from celery.signals import task_postrun
+
+EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
 
 if CELERY_SENTRY_URL:
     handler = SentryHandler(CELERY_SENTRY_URL)
@@ -29,9 +38,17 @@ def delete_dataset(self, source_url_hash):
     master_table = MasterTable.__table__
     delete = master_table.delete()\
         .where(master_table.c.dataset_name == md.dataset_name)
+    daily_table = MasterDailyCount.__table__
+    delete_daily = daily_table.delete()\
+        .where(daily_table.c.dataset_name == md.dataset_name)
+    grid_table = MasterGridCount.__table__
+    delete_grid = grid_table.delete()\
+        .where(grid_table.c.dataset_name == md.dataset_name)
     conn = engine.contextual_connect()
     try:
         conn.execute(delete)
+        conn.execute(delete_daily)
+        conn.execute(delete_grid)
         session.delete(md)
         session.commit()
     except InternalError, e:
@@ -77,9 +94,64 @@ def update_dataset(self, source_url_hash, s3_path=None):
             .where(MetaTable.source_url_hash == source_url_hash)\
             .values(result_ids=ids))
     etl = PlenarioETL(md.as_dict())
-    etl.update(s3_path=s3_path)
+    if not etl.update(s3_path=s3_path):
+        return '{0} ({1}) is unchanged'.format(md.human_name, md.source_url_hash)
     return 'Finished updating {0} ({1})'.format(md.human_name, md.source_url_hash)
 
+@celery_app.task(bind=True)
+def export_detail(self, sql, dataset_name):
+    """ 
+    Writes out the rows of 'sql' (a SELECT built by the /export endpoint
+    with its params already filled in) as a gzipped CSV, streaming them
+    straight from Postgres with COPY. The file is put on S3 when S3 is 
+    set up and kept in EXPORT_DIR otherwise. Returns where it went.
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        os.makedirs(EXPORT_DIR)
+    fname = '%s_%s.csv.gz' % (dataset_name, self.request.id)
+    fpath = os.path.join(EXPORT_DIR, fname)
+    copy_st = 'COPY (%s) TO STDOUT WITH (FORMAT CSV, HEADER TRUE)' % sql
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        with gzip.open(fpath, 'wb') as f:
+            cursor.copy_expert(copy_st, f)
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+    if AWS_ACCESS_KEY != '':
+        s3conn = S3Connection(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        key = Key(s3conn.get_bucket(S3_BUCKET))
+        key.key = 'exports/%s' % fname
+        key.set_contents_from_filename(fpath)
+        os.remove(fpath)
+        return {'s3_key': key.key, 'filename': fname}
+    return {'path': fpath, 'filename': fname}
+
+@celery_app.task
+def expire_exports():
+    """ 
+    Deletes the export_detail files (local and on S3) that are older than
+    EXPORT_RETENTION seconds
+    """
+    removed = 0
+    if os.path.isdir(EXPORT_DIR):
+        cutoff = datetime.now() - timedelta(seconds=EXPORT_RETENTION)
+        for fname in os.listdir(EXPORT_DIR):
+            fpath = os.path.join(EXPORT_DIR, fname)
+            if datetime.fromtimestamp(os.path.getmtime(fpath)) < cutoff:
+                os.remove(fpath)
+                removed += 1
+    if AWS_ACCESS_KEY != '':
+        cutoff = datetime.utcnow() - timedelta(seconds=EXPORT_RETENTION)
+        s3conn = S3Connection(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        for key in s3conn.get_bucket(S3_BUCKET).list(prefix='exports/'):
+            if parse_ts(key.last_modified) < cutoff:
+                key.delete()
+                removed += 1
+    return 'Removed %s expired exports' % removed
+
 @celery_app.task
 def update_metar():
     print "update_metar()"
@@ -111,3 +183,22 @@ def update_weather():
     # delete all metars before that datetime.
     w.clear_metars(year, month, weather_stations_list=stations)
     return 'Added weather for %s %s' % (month, year)
+
+@task_postrun.connect
+def update_last_task_status(sender=None, task=None, args=None, kwargs=None, 
+                            state=None, **kw):
+    """ 
+    Copies the final state of add_dataset and update_dataset tasks onto
+    meta_master so that the API can tell which datasets loaded 
+    successfully without searching celery_taskmeta.
+    """
+    if task.name not in [add_dataset.name, update_dataset.name]:
+        return
+    if args:
+        source_url_hash = args[0]
+    else:
+        source_url_hash = kwargs['source_url_hash']
+    with engine.begin() as c:
+        c.execute(MetaTable.__table__.update()\
+            .where(MetaTable.source_url_hash == source_url_hash)\
+            .values(last_task_status=state))
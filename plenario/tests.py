@@ -174,6 +174,50 @@ class WoprTest(unittest.TestCase):
         self.assertIn('HW569534', cases)
         self.assertEqual(resp.status_code, 200)
 
+    def test_detail_updated_record(self):
+        # An ETL update retires the old version of a changed record
+        # (current_flag off) and inserts the new one next to it
+        old_crime = self.session.query(Crime)\
+            .filter(Crime.case_number == 'HW570222').first()
+        old_master = self.session.query(Master)\
+            .filter(Master.dataset_name == 'chicago_crimes_all')\
+            .filter(Master.dataset_row_id == old_crime.chicago_crimes_all_row_id)\
+            .first()
+        new_crime = Crime(**dict((c.name, getattr(old_crime, c.name)) \
+            for c in Crime.__table__.columns))
+        new_crime.chicago_crimes_all_row_id = 9999999
+        new_crime.block = '054XX S ARCHER AVE'
+        new_master = Master(**dict((c.name, getattr(old_master, c.name)) \
+            for c in Master.__table__.columns))
+        new_master.master_row_id = 9999999
+        new_master.dataset_row_id = new_crime.chicago_crimes_all_row_id
+        old_crime.current_flag = False
+        old_master.current_flag = False
+        self.session.add(new_crime)
+        self.session.add(new_master)
+        self.session.commit()
+        try:
+            query = {
+                'obs_date__ge': '2013/07/15',
+                'obs_date__le': '2014/01/01',
+                'case_number': 'HW570222',
+                'dataset_name': 'chicago_crimes_all',
+                'data_type': 'csv'
+            }
+            resp = self.app.get('/v1/api/detail/?%s' % urlencode(query))
+            rows = [r for r in csv.DictReader(StringIO(resp.data))]
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['block'], '054XX S ARCHER AVE')
+        finally:
+            # Put the shared fixtures back the way the other tests expect
+            self.session.rollback()
+            self.session.delete(new_master)
+            self.session.delete(new_crime)
+            old_crime.current_flag = True
+            old_master.current_flag = True
+            self.session.commit()
+
 
     def test_default_api(self):
         resp = self.app.get('/api/')
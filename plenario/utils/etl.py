@@ -1,19 +1,22 @@
 import requests
 import re
 import os
+import csv
+from hashlib import sha1
 from datetime import datetime, date, time
 from plenario.database import task_session as session, task_engine as engine
 
 from plenario.models import MetaTable, MasterTable
-from plenario.utils.helpers import slugify, iter_column
-from plenario.settings import AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET, DATA_DIR
+from plenario.utils.helpers import slugify, infer_csv_types, getSizeInDegrees, \
+    GRID_RESOLUTIONS, GRID_CENTER
+from plenario.settings import AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET, DATA_DIR, \
+    TYPE_INFERENCE_SAMPLE
 from urlparse import urlparse
-from csvkit.unicsv import UnicodeCSVReader
 from plenario.utils.typeinference import normalize_column_type
 import gzip
 from sqlalchemy import Boolean, Float, DateTime, Date, Time, String, Column, \
-    Integer, Table, text, func, select, or_, and_, cast, UniqueConstraint, \
-    join, outerjoin, over, BigInteger, MetaData
+    Integer, Table, text, func, select, or_, and_, cast, \
+    join, outerjoin, over, BigInteger, MetaData, Index, literal_column
 from sqlalchemy.dialects.postgresql import TIMESTAMP, ARRAY, TIME
 from sqlalchemy.exc import NoSuchTableError, InternalError, \
     IntegrityError, DataError
@@ -23,7 +26,6 @@ from geoalchemy2.shape import from_shape
 from shapely.geometry import box
 from boto.s3.connection import S3Connection, S3ResponseError
 from boto.s3.key import Key
-from cStringIO import StringIO
 
 COL_TYPES = {
     'boolean': Boolean,
@@ -37,12 +39,67 @@ COL_TYPES = {
     'datetime': TIMESTAMP,
 }
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 class PlenarioETLError(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
         self.message = message
 
 
+class TeeReader(object):
+    """
+    Read only file over the chunks of a streamed download that also 
+    gzips every chunk it hands out into an archive at 'archive_path'. 
+    Only what a single read asks for is kept in memory. The archive is 
+    written to '<archive_path>.part' and moved into place on close() so
+    an interrupted download is never mistaken for a complete one.
+    'hash' is a sha1 of the download, complete once it has been closed.
+    """
+    
+    def __init__(self, chunks, archive_path):
+        self.chunks = iter(chunks)
+        self.archive_path = archive_path
+        self.archive = gzip.open('%s.part' % archive_path, 'wb')
+        self.hash = sha1()
+        self.buf = ''
+
+    def _fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.archive.write(chunk)
+                self.hash.update(chunk)
+                self.buf += chunk
+                return True
+        return False
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self.buf:
+            if not self._fill():
+                break
+        end = self.buf.find('\n') + 1 or len(self.buf)
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+    def close(self):
+        # Whatever was not read still belongs in the archive
+        for chunk in self.chunks:
+            if chunk:
+                self.archive.write(chunk)
+                self.hash.update(chunk)
+        self.buf = ''
+        self.archive.close()
+        os.rename('%s.part' % self.archive_path, self.archive_path)
+
 class PlenarioETL(object):
     
     def __init__(self, meta, data_types=None):
@@ -115,6 +172,8 @@ class PlenarioETL(object):
             self.data_types = data_types
 
         self.s3_key = None
+        self.data_dir = DATA_DIR
+        self.download = None
 
         self.metadata = MetaData()
         
@@ -158,10 +217,7 @@ class PlenarioETL(object):
                 pass
 
     def add(self, s3_path=None):
-        if s3_path and s3_key:
-            self.s3_key.key = s3_path
-        else:
-            self._download_csv()
+        self._open_source(s3_path)
         self._get_or_create_data_table()
         self._make_src_table()
         self._insert_src_data()
@@ -172,54 +228,122 @@ class PlenarioETL(object):
         self._update_master()
         self._update_meta(added=True)
         self._update_geotags()
+        self._update_master_daily(added=True)
+        self._update_master_grid(added=True)
         self._cleanup_temp_tables()
     
     def update(self, s3_path=None):
-        if s3_path and s3_key:
-            self.s3_key.key = s3_path
-        else:
-            self._download_csv()
+        """
+        Loads the new and changed rows of the source. Returns False (having
+        left Postgres alone) when the source is the same as the last time
+        it was loaded.
+        """
+        if not self._open_source(s3_path, skip_unchanged=True):
+            return False
         self._get_or_create_data_table()
         self._make_src_table()
         self._insert_src_data()
         self._make_new_and_dup_table()
         self._find_dup_data()
         new = self._insert_new_data()
-        if new:
+        changes = self._find_changes()
+        if changes:
+            self._update_dat_current_flag()
+            self._update_master_current_flag()
+        if new or changes:
             self._insert_data_table()
             self._update_master()
-           #changes = self._find_changes()
-           #if changes:
-           #    self._update_dat_current_flag()
-           #    self._update_master_current_flag()
         self._update_meta()
         self._update_geotags()
+        if new or changes:
+            self._update_master_daily()
+            self._update_master_grid()
         self._cleanup_temp_tables()
+        return True
 
-    def _download_csv(self):
-        r = requests.get(self.source_url, stream=True)
- 
-        if (self.s3_key):
-            s = StringIO()
-            with gzip.GzipFile(fileobj=s, mode='wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-            s.seek(0)
-            self.s3_key.set_contents_from_file(s)
-            self.s3_key.make_public()
+    def _open_source(self, s3_path=None, skip_unchanged=False):
+        """
+        Gets the source CSV ready to be read once, top to bottom, by the
+        COPY in _insert_src_data. A download is archived (gzipped) on 
+        its way into the COPY and the archive is uploaded to S3 once the
+        COPY is done. An archive that already exists (the local file or
+        the one at 's3_path') is read instead of downloading again.
+
+        With 'skip_unchanged' the source is always downloaded (unless 
+        's3_path' is given) and False is returned when it hasn't changed
+        since it was last loaded (see _download_csv).
+        """
+        self.upload_archive = False
+        if self.s3_key:
+            if s3_path:
+                self.s3_key.key = s3_path
+            # Staged on local disk and removed after the upload
+            self.fpath = os.path.join(self.data_dir, 
+                self.s3_key.key.replace('/', '_'))
+            if s3_path:
+                self.s3_key.get_contents_to_filename(self.fpath)
+                self.source = gzip.open(self.fpath, 'rb')
+            else:
+                self.source = self._download_csv(skip_unchanged)
+                self.upload_archive = True
         else:
-            # write out a la shapefile_helpers
             self.fpath = os.path.join(self.data_dir, self.fname)
-            if not os.path.exists(self.fpath):
-                gz_f = gzip.open(self.fpath, 'wb')
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        gz_f.write(chunk)
-                        gz_f.flush()
-                gz_f.close() # Explicitly close before re-opening to read.
- 
+            if os.path.exists(self.fpath) and not skip_unchanged:
+                self.source = gzip.open(self.fpath, 'rb')
+            else:
+                self.source = self._download_csv(skip_unchanged)
+        if self.source is None:
+            return False
+        self._read_header()
+        return True
+
+    def _download_csv(self, skip_unchanged=False):
+        """
+        Returns a TeeReader over the source. With 'skip_unchanged' the 
+        request is conditional on the ETag and Last-Modified headers from
+        the last load and the whole download is hashed before anything
+        is read from it. None is returned when the server answers 304 or
+        the hash is the same as the last load's.
+        """
+        headers = {}
+        if skip_unchanged:
+            if getattr(self, 'source_etag', None):
+                headers['If-None-Match'] = self.source_etag
+            if getattr(self, 'source_last_modified', None):
+                headers['If-Modified-Since'] = self.source_last_modified
+        r = requests.get(self.source_url, stream=True, headers=headers)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        self.download_headers = (r.headers.get('ETag'), 
+            r.headers.get('Last-Modified'))
+        self.download = TeeReader(r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), 
+            self.fpath)
+        if not skip_unchanged:
+            return self.download
+        # The hash is only known once all of the source has been read so 
+        # it is downloaded to the archive first and the COPY reads that
+        self.download.close()
+        if self.download.hash.hexdigest() == getattr(self, 'source_hash', None):
+            if self.s3_key:
+                os.remove(self.fpath)
+            return None
+        return gzip.open(self.fpath, 'rb')
+
+    def _read_header(self):
+        # Reads just the header row (csv.reader asks for one line at a 
+        # time) so the COPY starts at the first row of data
+        reader = csv.reader(iter(self.source.readline, ''))
+        self.header = [slugify(h.decode('utf-8')) for h in reader.next()]
+
+    def _close_source(self):
+        self.source.close()
+        if self.s3_key:
+            if self.upload_archive:
+                self.s3_key.set_contents_from_filename(self.fpath)
+                self.s3_key.make_public()
+            os.remove(self.fpath)
+
     def _cleanup_temp_tables(self):
         self.src_table.drop(bind=engine, checkfirst=True)
         self.new_table.drop(bind=engine, checkfirst=True)
@@ -234,15 +358,9 @@ class PlenarioETL(object):
         try:
             self.dat_table = Table('dat_%s' % self.dataset_name, self.metadata, 
                 autoload=True, autoload_with=engine, extend_existing=True)
+            if 'row_hash' not in self.dat_table.c:
+                self._add_row_hashes()
         except NoSuchTableError:
-            s = StringIO()
-            if (self.s3_key):
-                self.s3_key.get_contents_to_file(s)
-            else:
-                # XX read the file out of DATA_DIR
-                with open(self.fpath, 'r') as f:
-                    s.write(f.read())
-            s.seek(0)
             cols = [
                 Column('%s_row_id' % self.dataset_name, Integer, primary_key=True),
                 Column('start_date', TIMESTAMP, server_default=text('CURRENT_TIMESTAMP')),
@@ -250,33 +368,82 @@ class PlenarioETL(object):
                 Column('current_flag', Boolean, server_default=text('TRUE')),
                 Column('dup_ver', Integer)
             ]
-            with gzip.GzipFile(fileobj=s, mode='rb') as f:
-                reader = UnicodeCSVReader(f)
-                header = map(slugify, reader.next())
-
-                col_types = []
-                try:
-                    types = getattr(self, 'data_types')
-                    col_map = {c['field_name']: c['data_type'] for c in types}
-                    for col in header:
-                        t = col_map[col]
-                        col_types.append((COL_TYPES[t], True)) # always nullable
-                except AttributeError:
-                    for col in range(len(header)):
-                        col_types.append(iter_column(col, f))
+            header = self.header
+            col_types = []
+            try:
+                types = getattr(self, 'data_types')
+                col_map = {c['field_name']: c['data_type'] for c in types}
+                for col in header:
+                    t = col_map[col]
+                    col_types.append((COL_TYPES[t], True)) # always nullable
+            except AttributeError:
+                col_types = self._infer_column_types()
             for col_name,d_type in zip(header, col_types):
                 dt, nullable = d_type
                 cols.append(Column(col_name, dt, nullable=nullable))
-            cols.append(UniqueConstraint(slugify(self.business_key), 'dup_ver', 
-                    name='%s_ix' % self.dataset_name[:50]))
+            cols.append(Column('row_hash', String(32)))
             self.dat_table = Table('dat_%s' % self.dataset_name, self.metadata, 
                           *cols, extend_existing=True)
+            # Changed records are kept next to the versions they replace 
+            # so the business key and dup_ver only identify current ones
+            Index('%s_ix' % self.dataset_name[:50], 
+                self.dat_table.c[slugify(self.business_key)], 
+                self.dat_table.c.dup_ver, unique=True,
+                postgresql_where=self.dat_table.c.current_flag == True)
             self.dat_table.create(engine, checkfirst=True)
 
+    def _source_columns(self):
+        # The columns of the data table that come from the source
+        skip_cols = ['%s_row_id' % self.dataset_name, 'start_date', 'end_date', 
+            'current_flag', 'dup_ver', 'row_hash']
+        return [c.name for c in self.dat_table.columns if c.name not in skip_cols]
+
+    def _row_hash(self, table_name):
+        """
+        SQL for the md5 of a row's source columns in 'table_name' (the 
+        src or dat table). Records whose hash differs from the one stored
+        on dat_<dataset_name> have changed.
+        """
+        cols = ', '.join(['%s.%s' % (table_name, c) for c in self._source_columns()])
+        return 'md5(ROW(%s)::text)' % cols
+
+    def _add_row_hashes(self):
+        """
+        Brings a data table made before records were hashed up to date.
+        It adds and fills in row_hash. The business key and dup_ver 
+        constraint becomes a unique index on current records only.
+        """
+        bk = slugify(self.business_key)
+        ix_name = '%s_ix' % self.dataset_name[:50]
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE dat_{0} ADD COLUMN row_hash VARCHAR(32)'\
+                .format(self.dataset_name))
+            conn.execute('UPDATE dat_{0} SET row_hash = {1}'\
+                .format(self.dataset_name, self._row_hash('dat_%s' % self.dataset_name)))
+            conn.execute('ALTER TABLE dat_{0} DROP CONSTRAINT IF EXISTS {1}'\
+                .format(self.dataset_name, ix_name))
+            conn.execute('''
+                CREATE UNIQUE INDEX {1} ON dat_{0} ({2}, dup_ver) 
+                WHERE current_flag = TRUE
+                '''.format(self.dataset_name, ix_name, bk))
+        self.dat_table = Table('dat_%s' % self.dataset_name, self.metadata, 
+            autoload=True, autoload_with=engine, extend_existing=True)
+
+    def _infer_column_types(self):
+        # Rows from all over the file (every row, or a sample of them) have
+        # a say in the types so the whole source is read (and archived) 
+        # first and the COPY reads the archive afterwards
+        self.source.close()
+        with gzip.open(self.fpath, 'rb') as f:
+            col_types = infer_csv_types(f, sample_size=TYPE_INFERENCE_SAMPLE)
+        self.source = gzip.open(self.fpath, 'rb')
+        self._read_header()
+        return col_types
+
     def _make_src_table(self):
         # Step Two
         cols = []
-        skip_cols = ['%s_row_id' % self.dataset_name, 'start_date', 'end_date', 'current_flag', 'dup_ver']
+        skip_cols = ['%s_row_id' % self.dataset_name, 'start_date', 'end_date', 'current_flag', 'dup_ver', 'row_hash']
         for col in self.dat_table.columns:
             if col.name not in skip_cols:
                 kwargs = {}
@@ -302,26 +469,20 @@ class PlenarioETL(object):
                 else:
                     copy_st += '%s)' % name
         else:
-            copy_st += "FROM STDIN WITH (FORMAT CSV, HEADER TRUE, DELIMITER ',')"
+            # _read_header has already read the header off the source
+            copy_st += "FROM STDIN WITH (FORMAT CSV, HEADER FALSE, DELIMITER ',')"
         conn = engine.raw_connection()
-        s = StringIO()
-        if (self.s3_key):
-            self.s3_key.get_contents_to_file(s)
-        else:
-            with open(self.fpath, 'r') as f:
-                s.write(f.read())
-        s.seek(0)
-        with gzip.GzipFile(fileobj=s, mode='rb') as f:
-            try:
-                cursor = conn.cursor()
-                cursor.copy_expert(copy_st, f)
-                cursor.close()
-                conn.commit()
-            except Exception, e:
-                conn.rollback()
-                raise PlenarioETLError(e)
-            finally:
-                conn.close()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(copy_st, self.source, size=DOWNLOAD_CHUNK_SIZE)
+            cursor.close()
+            conn.commit()
+        except Exception, e:
+            conn.rollback()
+            raise PlenarioETLError(e)
+        finally:
+            conn.close()
+        self._close_source()
            #    conn.commit()
            #except DataError, e:
            #    conn.rollback()
@@ -380,7 +541,8 @@ class PlenarioETL(object):
         cols = [
             Column(slugify(self.business_key), bk_col.type, primary_key=True),
             Column('line_num', Integer),
-            Column('dup_ver', Integer, primary_key=True)
+            Column('dup_ver', Integer, primary_key=True),
+            Column('row_hash', String(32))
         ]
         self.new_table = Table('new_%s' % self.dataset_name, self.metadata,
             *cols, extend_existing=True)
@@ -390,7 +552,8 @@ class PlenarioETL(object):
         cols = [
             Column(slugify(self.business_key), bk_col.type, primary_key=True),
             Column('line_num', Integer),
-            Column('dup_ver', Integer, primary_key=True)
+            Column('dup_ver', Integer, primary_key=True),
+            Column('row_hash', String(32))
         ]
         self.dup_table = Table('dup_%s' % self.dataset_name, self.metadata,
             *cols, extend_existing=True)
@@ -407,6 +570,8 @@ class PlenarioETL(object):
             .over(partition_by=getattr(self.src_table.c, slugify(self.business_key)), 
                 order_by=self.src_table.columns['line_num'].desc())\
             .label('dup_ver'))
+        cols.append(literal_column(self._row_hash(self.src_table.name))\
+            .label('row_hash'))
         sel = select(cols, from_obj=self.src_table)
         ins = self.dup_table.insert()\
             .from_select([c for c in self.dup_table.columns], sel)
@@ -419,7 +584,8 @@ class PlenarioETL(object):
         sel_cols = [
             self.src_table.c[bk], 
             self.src_table.c['line_num'], 
-            self.dup_table.c['dup_ver']
+            self.dup_table.c['dup_ver'],
+            self.dup_table.c['row_hash']
         ]
         j = join(self.src_table, self.dup_table, 
             and_(self.src_table.c['line_num'] == self.dup_table.c['line_num'], 
@@ -427,7 +593,8 @@ class PlenarioETL(object):
         dup_tablename = self.dup_table.name
         outer = outerjoin(j, self.dat_table, 
               and_(self.dat_table.c[bk] == j.c['%s_%s' % (dup_tablename, bk)], 
-                   self.dat_table.c['dup_ver'] == j.c['%s_dup_ver' % dup_tablename]))
+                   self.dat_table.c['dup_ver'] == j.c['%s_dup_ver' % dup_tablename],
+                   self.dat_table.c.current_flag == True))
         sel = select(sel_cols).select_from(outer)
         if not added:
             sel = sel.where(self.dat_table.c['%s_row_id' % self.dataset_name] == None)
@@ -444,17 +611,19 @@ class PlenarioETL(object):
     def _insert_data_table(self):
         # Step Seven
         bk = slugify(self.business_key)
-        skip_cols = ['%s_row_id' % self.dataset_name,'end_date', 'current_flag', 'line_num']
+        skip_cols = ['%s_row_id' % self.dataset_name,'end_date', 'current_flag', 'line_num', 'row_hash']
         from_vals = []
         from_vals.append(text("'%s' AS start_date" % datetime.now().isoformat()))
         from_vals.append(self.new_table.c.dup_ver)
         for c_src in self.src_table.columns:
             if c_src.name not in skip_cols:
                 from_vals.append(c_src)
+        from_vals.append(self.new_table.c.row_hash)
         sel = select(from_vals, from_obj = self.src_table)
         ins = self.dat_table.insert()\
             .from_select(
-                [c for c in self.dat_table.columns if c.name not in skip_cols], 
+                [c for c in self.dat_table.columns if c.name not in skip_cols] + \
+                    [self.dat_table.c.row_hash], 
                 sel.select_from(self.src_table.join(self.new_table, 
                         and_(
                             self.src_table.c.line_num == self.new_table.c.line_num,
@@ -529,7 +698,8 @@ class PlenarioETL(object):
                         .select_from(self.dat_table.join(self.new_table, 
                             and_(
                                 getattr(self.dat_table.c, bk) == getattr(self.new_table.c, bk),
-                                self.dat_table.c.dup_ver == self.new_table.c.dup_ver
+                                self.dat_table.c.dup_ver == self.new_table.c.dup_ver,
+                                self.dat_table.c.current_flag == True
                             )
                         )
                     )
@@ -544,61 +714,58 @@ class PlenarioETL(object):
 
     def _add_weather_info(self):
         """ 
-        This is just adding the weather observation id to the master table right now.
-        In the future we can modify it to do all the geo tagging we need for the
-        master table.
-
-        The update below assumes the weather stations table has already been
-        created and populated. I have no idea how to do it in SQLAlchemy, 
-        mainly because of the geometry distance operator ('<->')
+        Adds the weather observation id to the new records in the master 
+        table. Records are matched to the weather station nearest their 
+        census block (see census_block_weather_stations) so this is a 
+        plain join, not a nearest neighbor search per record. It runs 
+        after the census blocks are added. Daily weather is matched on
+        the date and hourly weather on the closest observation within 
+        an hour of obs_date.
         """
-
-        # Yo dawg, I heard you like subqueries. 
-        # I put a subquery in your subquery.
         date_type = str(getattr(self.dat_table.c, slugify(self.observed_date)).type)
         if 'timestamp' in date_type.lower():
             weather_table = 'dat_weather_observations_hourly'
-            date_col_name = 'datetime'
-            temp_col = 'drybulb_fahrenheit'
         else:
             weather_table = 'dat_weather_observations_daily'
-            date_col_name = 'date'
-            temp_col = 'temp_avg'
-        upd = text(
-            """
-            UPDATE dat_master SET weather_observation_id=subq.weather_id
-                FROM (
-                SELECT DISTINCT ON (d.master_row_id) 
-                d.master_row_id AS master_id, 
-                w.id as weather_id, 
-                abs(extract(epoch from d.obs_date) - extract(epoch from w.%s)) as diff 
-                FROM dat_master AS d 
-                JOIN %s as w 
-                  ON w.wban_code = (
-                    SELECT b.wban_code 
-                      FROM weather_stations AS b 
-                      ORDER BY d.location_geom <-> b.location LIMIT 1
-                    ) 
-                WHERE d.location_geom IS NOT NULL 
-                  AND d.weather_observation_id IS NULL 
-                  AND d.dataset_name = :dname 
-                  AND d.obs_date > (
-                    SELECT MIN(%s) 
-                      FROM %s 
-                      WHERE %s IS NOT NULL
-                    ) 
-                  AND d.obs_date < (
-                    SELECT MAX(%s) 
-                      FROM %s 
-                      WHERE %s IS NOT NULL
-                    ) 
-                ORDER BY d.master_row_id, diff
-              ) as subq
-            WHERE dat_master.master_row_id = subq.master_id
-            """ % (date_col_name, weather_table, 
-                   date_col_name, weather_table, temp_col,
-                   date_col_name, weather_table, temp_col,)
-        )
+        if not engine.has_table(weather_table) or \
+            not engine.has_table('census_block_weather_stations'):
+            return
+        if weather_table == 'dat_weather_observations_daily':
+            upd = text(
+                """
+                UPDATE dat_master SET weather_observation_id=w.id
+                FROM census_block_weather_stations AS s, 
+                     dat_weather_observations_daily AS w
+                WHERE s.geoid10 = dat_master.census_block
+                  AND w.wban_code = s.wban_code
+                  AND w.date = dat_master.obs_date::date
+                  AND dat_master.weather_observation_id IS NULL 
+                  AND dat_master.dataset_name = :dname 
+                """
+            )
+        else:
+            upd = text(
+                """
+                UPDATE dat_master SET weather_observation_id=subq.weather_id
+                    FROM (
+                    SELECT DISTINCT ON (d.master_row_id) 
+                    d.master_row_id AS master_id, 
+                    w.id as weather_id
+                    FROM dat_master AS d 
+                    JOIN census_block_weather_stations AS s
+                      ON s.geoid10 = d.census_block
+                    JOIN dat_weather_observations_hourly AS w 
+                      ON w.wban_code = s.wban_code
+                     AND w.datetime BETWEEN d.obs_date - interval '1 hour' 
+                                        AND d.obs_date + interval '1 hour'
+                    WHERE d.weather_observation_id IS NULL 
+                      AND d.dataset_name = :dname 
+                    ORDER BY d.master_row_id, 
+                      abs(extract(epoch from d.obs_date - w.datetime))
+                  ) as subq
+                WHERE dat_master.master_row_id = subq.master_id
+                """
+            )
         with engine.begin() as conn:
             conn.execute(upd, dname=self.dataset_name)
         
@@ -626,82 +793,154 @@ class PlenarioETL(object):
             conn.execute(upd, dname=self.dataset_name)
 
     def _update_geotags(self):
-        # self._add_weather_info()
         # self._add_weather_stations()
         self._add_census_block()
+        self._add_weather_info()
+
+    def _new_days(self):
+        """ 
+        SQL for the days that got new records in dat_master in this run.
+        Changed records are in new_<dataset_name> too and the join below
+        also matches the versions they replaced, so the days those were 
+        on are included.
+        """
+        return """
+            SELECT DISTINCT m.obs_date::date
+            FROM dat_master AS m
+            JOIN dat_{0} AS d
+              ON m.dataset_row_id = d.{0}_row_id
+            JOIN new_{0} AS n
+              ON d.{1} = n.{1} AND d.dup_ver = n.dup_ver
+            WHERE m.dataset_name = :dname
+        """.format(self.dataset_name, slugify(self.business_key))
+
+    def _update_master_daily(self, added=False):
+        """ 
+        Refreshes the dat_master_daily rollup for the days that got new 
+        records in dat_master (every day of the dataset when it was just 
+        added). This runs after the geotags are updated so that the 
+        census tract of the new records is known.
+        """
+        delete_filter, insert_filter = '', ''
+        if not added:
+            delete_filter = 'AND obs_day IN (%s)' % self._new_days()
+            insert_filter = 'AND obs_date::date IN (%s)' % self._new_days()
+        delete = text("""
+            DELETE FROM dat_master_daily 
+            WHERE dataset_name = :dname {0}
+            """.format(delete_filter))
+        ins = text("""
+            INSERT INTO dat_master_daily 
+                (dataset_name, obs_day, at_midnight, census_tract, obs_count)
+            SELECT 
+                dataset_name,
+                obs_date::date,
+                obs_date = obs_date::date,
+                COALESCE(SUBSTRING(census_block FROM 1 FOR 11), ''),
+                COUNT(*)
+            FROM dat_master
+            WHERE dataset_name = :dname
+              AND current_flag = TRUE
+              AND obs_date IS NOT NULL {0}
+            GROUP BY 1, 2, 3, 4
+            """.format(insert_filter))
+        with engine.begin() as conn:
+            conn.execute(delete, dname=self.dataset_name)
+            conn.execute(ins, dname=self.dataset_name)
+
+    def _update_master_grid(self, added=False):
+        """ 
+        Refreshes the dat_master_grid counts for the days that got new 
+        records in dat_master (every day of the dataset when it was just 
+        added) at each of the GRID_RESOLUTIONS. 
+        """
+        delete_filter, insert_filter = '', ''
+        if not added:
+            delete_filter = 'AND obs_day IN (%s)' % self._new_days()
+            insert_filter = 'AND obs_date::date IN (%s)' % self._new_days()
+        delete = text("""
+            DELETE FROM dat_master_grid 
+            WHERE dataset_name = :dname {0}
+            """.format(delete_filter))
+        ins = text("""
+            INSERT INTO dat_master_grid 
+                (dataset_name, obs_day, at_midnight, resolution, x, y, obs_count)
+            SELECT 
+                dataset_name, obs_day, at_midnight, :resolution, 
+                ST_X(cell), ST_Y(cell), COUNT(*)
+            FROM (
+                SELECT 
+                    dataset_name,
+                    obs_date::date AS obs_day,
+                    obs_date = obs_date::date AS at_midnight,
+                    ST_SnapToGrid(location_geom, :size_x, :size_y) AS cell
+                FROM dat_master
+                WHERE dataset_name = :dname
+                  AND current_flag = TRUE
+                  AND obs_date IS NOT NULL {0}
+            ) AS snapped
+            GROUP BY 1, 2, 3, 4, 5, 6
+            """.format(insert_filter))
+        with engine.begin() as conn:
+            conn.execute(delete, dname=self.dataset_name)
+            for resolution in GRID_RESOLUTIONS:
+                size_x, size_y = getSizeInDegrees(resolution, GRID_CENTER[0])
+                conn.execute(ins, dname=self.dataset_name, 
+                    resolution=resolution, size_x=size_x, size_y=size_y)
 
     def _find_changes(self):
-        # Step Eight: Find changes
-        bk = slugify(self.business_key)
+        """ 
+        Finds the current records whose row hash differs from the hash of
+        the source row with the same business key and dup_ver. Their ids
+        go in chg_<dataset_name> and the source rows go in 
+        new_<dataset_name> so they are loaded as new versions. Returns 
+        True when there are any.
+        """
         self.chg_table = Table('chg_%s' % self.dataset_name, self.metadata,
                       Column('id', Integer), 
                       extend_existing=True)
         self.chg_table.drop(bind=engine, checkfirst=True)
         self.chg_table.create(bind=engine)
-        bk = slugify(self.business_key)
-        skip_cols = ['start_date', 'end_date', 'current_flag', bk, 
-            '%s_row_id' % self.dataset_name, 'dup_ver']
-        src_cols = [c for c in self.src_table.columns if c.name != bk]
-        dat_cols = [c for c in self.dat_table.columns if c.name not in skip_cols]
-        and_args = []
-        for s,d in zip(src_cols, dat_cols):
-            ors = or_(s != None, d != None)
-            ands = and_(ors, s != d)
-            and_args.append(ands)
-        pk = getattr(self.dat_table.c, '%s_row_id' % self.dataset_name)
-        ins = self.chg_table.insert()\
-            .from_select(
-                ['id'],
-                select([pk])\
-                    .select_from(
-                        join(self.dat_table, self.src_table, 
-                            self.dat_table.c.service_request_number == \
-                                self.src_table.c.service_request_number)\
-                        .join(self.dup_table, self.src_table.c.line_num == self.dup_table.c.line_num))\
-                    .where(or_(*and_args))\
-                    .where(and_(self.dat_table.c.current_flag == True, 
-                        or_(getattr(self.src_table.c, bk) != None, 
-                            getattr(self.dat_table.c, bk) != None)))
-            )
-        conn = engine.connect()
-        try:
-            with engine.begin() as conn:
-                conn.execute(ins)
-                return True
-        except TypeError:
-            # No changes found
-            return False
+        self.changed_at = datetime.now()
+        changed = """
+            FROM dup_{0} AS n
+            JOIN dat_{0} AS d
+              ON d.{1} = n.{1} AND d.dup_ver = n.dup_ver
+            WHERE d.current_flag = TRUE
+              AND d.row_hash <> n.row_hash
+            """.format(self.dataset_name, slugify(self.business_key))
+        ins_chg = text("""
+            INSERT INTO chg_{0} (id)
+            SELECT d.{0}_row_id {1}
+            """.format(self.dataset_name, changed))
+        ins_new = text("""
+            INSERT INTO new_{0} ({1}, line_num, dup_ver, row_hash)
+            SELECT n.{1}, n.line_num, n.dup_ver, n.row_hash {2}
+            """.format(self.dataset_name, slugify(self.business_key), changed))
+        with engine.begin() as conn:
+            changes = conn.execute(ins_chg).rowcount
+            if changes:
+                conn.execute(ins_new)
+        return changes > 0
 
     def _update_dat_current_flag(self):
-        # Step Nine: Update data table with changed records
-
-        # Need to figure out how to make the end_date more granular than a day. 
-        # For datasets that update more frequently than every day, this will be
-        # crucial so that we are updating the current_flag on the correct records.
-        pk = getattr(self.dat_table.c, '%s_row_id' % self.dataset_name)
-        update = self.dat_table.update()\
-            .values(current_flag=False, end_date=datetime.now().strftime('%Y-%m-%d'))\
-            .where(pk == self.chg_table.c.id)\
-            .where(self.dat_table.c.current_flag == True)
+        # Step Nine: Retire the changed records in the data table
+        upd = text("""
+            UPDATE dat_{0} SET current_flag = FALSE, end_date = :end_date
+            WHERE {0}_row_id IN (SELECT id FROM chg_{0})
+            """.format(self.dataset_name))
         with engine.begin() as conn:
-            conn.execute(update)
-        return None
+            conn.execute(upd, end_date=self.changed_at)
 
     def _update_master_current_flag(self):
-        # Step Ten: Update master table with changed records
-
-        # Need to figure out how to make the end_date more granular than a day. 
-        # For datasets that update more frequently than every day, this will be
-        # crucial so that we are updating the current_flag on the correct records.
-        mt = MasterTable.__table__
-        update = mt.update()\
-            .values(current_flag=False, end_date=datetime.now().strftime('%Y-%m-%d'))\
-            .where(mt.c.dataset_row_id == getattr(self.dat_table.c, '%s_row_id' % self.dataset_name))\
-            .where(self.dat_table.c.current_flag == False)\
-            .where(self.dat_table.c.end_date == datetime.now().strftime('%Y-%m-%d'))
+        # Step Ten: Retire the changed records in the master table
+        upd = text("""
+            UPDATE dat_master SET current_flag = FALSE, end_date = :end_date
+            WHERE dataset_name = :dname
+              AND dataset_row_id IN (SELECT id FROM chg_{0})
+            """.format(self.dataset_name))
         with engine.begin() as conn:
-            conn.execute(update)
-        return None
+            conn.execute(upd, end_date=self.changed_at, dname=self.dataset_name)
 
     def _update_meta(self, added=False):
         """ 
@@ -715,6 +954,10 @@ class PlenarioETL(object):
         md.last_update = now
         if added:
             md.date_added = now
+        if self.download is not None:
+            # What _download_csv compares the next download to
+            md.source_etag, md.source_last_modified = self.download_headers
+            md.source_hash = self.download.hash.hexdigest()
         obs_date_col = getattr(self.dat_table.c, slugify(self.observed_date))
         obs_from, obs_to = session.query(
                                func.min(obs_date_col), 
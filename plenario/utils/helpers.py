@@ -1,32 +1,63 @@
 import requests
 import re
+import random
 from unicodedata import normalize
 import calendar
+import math
 import string
 from datetime import timedelta
 from csvkit.unicsv import UnicodeCSVReader
-from plenario.utils.typeinference import normalize_column_type
+from plenario.utils.typeinference import ColumnTypeGuess
 from flask_mail import Mail, Message
 from plenario.settings import MAIL_DISPLAY_NAME, MAIL_USERNAME, ADMIN_EMAIL
 from smtplib import SMTPAuthenticationError
 
 mail = Mail()
 
+# Grid resolutions (in meters) offered by the explore page and the map 
+# center it uses. dat_master_grid holds counts for these.
+GRID_RESOLUTIONS = [100, 200, 300, 400, 500, 1000]
+GRID_CENTER = [41.880517, -87.644061]
 
-def iter_column(idx, f):
-    f.seek(0)
+# Rows at the top of a CSV that infer_csv_types always checks when sampling
+INFERENCE_HEAD_SIZE = 1000
+
+
+def infer_csv_types(f, sample_size=None, head_size=INFERENCE_HEAD_SIZE):
+    """
+    Reads the CSV in 'f' once and returns a (type, null_values) pair for 
+    each of its columns. When 'sample_size' is given, only the first
+    'head_size' rows and a random sample (reservoir) of 'sample_size' of
+    the remaining rows are checked.
+    """
     reader = UnicodeCSVReader(f)
     header = reader.next()
-    col = []
+    columns = [ColumnTypeGuess() for h in header]
+
+    def add_row(row):
+        # Short rows are bad data, their missing values are skipped
+        for column, value in zip(columns, row):
+            column.add(value)
+
+    reservoir = []
+    seen = 0
     for row in reader:
-        if row:
-            try:
-                col.append(row[idx])
-            except IndexError:
-                # Bad data. Maybe we can fill with nulls?
-                pass
-    col_type, null_values = normalize_column_type(col)
-    return col_type, null_values
+        if not row:
+            continue
+        if sample_size is None or head_size > 0:
+            add_row(row)
+            head_size -= 1
+            continue
+        if seen < sample_size:
+            reservoir.append(row)
+        else:
+            i = random.randint(0, seen)
+            if i < sample_size:
+                reservoir[i] = row
+        seen += 1
+    for row in reservoir:
+        add_row(row)
+    return [c.result() for c in columns]
 
 def get_socrata_data_info(host, path, four_by_four):
     errors = []
@@ -135,6 +166,44 @@ def increment_datetime_aggregate(sourcedate, time_agg):
 
     return sourcedate + delta
 
+def datetime_aggregate_range(from_date, to_date, time_agg):
+    """
+    Returns every bucket of the 'time_agg' aggregate from 'from_date' 
+    through 'to_date'
+    """
+    buckets = []
+    cursor = from_date
+    while cursor <= to_date:
+        buckets.append(cursor)
+        cursor = increment_datetime_aggregate(cursor, time_agg)
+    return buckets
+
+def fill_datetime_aggregate(buckets, values):
+    """
+    Takes (datetime, count) pairs from a date_trunc query (which skips 
+    empty buckets) and returns an item for every bucket in 'buckets',
+    counting 0 for the ones that had no rows.
+    """
+    counts = {}
+    for value in values:
+        counts[value[0].replace(tzinfo=None)] = value[1]
+    get = counts.get
+    return [{'datetime': b, 'count': get(b, 0)} for b in buckets]
+
+def getSizeInDegrees(meters, latitude):
+
+    earth_circumference = 40041000.0 # meters, average circumference
+    degrees_per_meter = 360.0 / earth_circumference
+    
+    degrees_at_equator = meters * degrees_per_meter
+
+    latitude_correction = 1.0 / math.cos(latitude * (math.pi / 180.0))
+    
+    degrees_x = degrees_at_equator * latitude_correction
+    degrees_y = degrees_at_equator
+
+    return degrees_x, degrees_y
+
 def send_mail(subject, recipient, body):
     msg = Message(subject,
               sender=(MAIL_DISPLAY_NAME, MAIL_USERNAME),
@@ -12,136 +12,209 @@ NoneType = type(None)
 NULL_VALUES = ('na', 'n/a', 'none', 'null', '.', '', ' ')
 TRUE_VALUES = ('yes', 'y', 'true', 't',)
 FALSE_VALUES = ('no', 'n', 'false', 'f',)
+BOOLEAN_VALUES = TRUE_VALUES + FALSE_VALUES
+
+# Most distinct values ColumnTypeGuess holds back before parsing them as 
+# dates anyway
+MAX_PENDING_DATES = 10000
 
 DEFAULT_DATETIME = datetime.datetime(2999, 12, 31, 0, 0, 0)
 NULL_DATE = datetime.date(2999, 12, 31)
 NULL_TIME = datetime.time(0, 0, 0)
 
+# Formats ColumnTypeGuess tries on the dates it has to parse. Once one 
+# reads a value the same way dateutil's parse does it is used for the 
+# values after it, and parse (which is much slower) only sees the ones 
+# it doesn't fit.
+DATE_FORMATS = (
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y %I:%M %p',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+    '%H:%M:%S',
+    '%H:%M',
+    '%I:%M:%S %p',
+    '%I:%M %p',
+)
+# Most times a column looks for a format to learn before giving up on it
+MAX_FORMAT_GUESSES = 10
+
 
 def normalize_column_type(l):
     """
-    Docs to come...
+    Returns the type of the values in 'l' and whether any of them were 
+    null (see ColumnTypeGuess)
     """
-    
-    null_values = False
+    column = ColumnTypeGuess()
+    for x in l:
+        column.add(x)
+    return column.result()
 
-    # Convert "NA", "N/A", etc. to null types.
-    for i, x in enumerate(l):
-        if x is not None and x.lower() in NULL_VALUES:
-            l[i] = None
-            null_values = True
 
-    # Are they boolean?
-    try:
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                raise ValueError('Not boolean')
-            elif x.lower() in TRUE_VALUES:
-                continue
-            elif x.lower() in FALSE_VALUES:
-                continue
-            else:
-                raise ValueError('Not boolean')
-
-        return Boolean, null_values
-    except ValueError:
-        pass
+class ColumnTypeGuess(object):
+    """
+    Works out the type of a column one value at a time so a CSV can be
+    read once for all of its columns. The first of boolean, integer, 
+    float, date/time and string that every value fits wins.
+
+    Boolean, integer and float stay candidates until a value doesn't fit
+    them. Dates only get a say once those three are out and parsing
+    them is slow, so until then the distinct values are held back and
+    only parsed if it comes to that (or once there are more than 
+    MAX_PENDING_DATES of them). Dates that fit the format learned from
+    the ones before them (see DATE_FORMATS) skip dateutil's parse.
+    """
 
-    # Are they integers?
-    try:
-        normal_types_set = set()
-        add = normal_types_set.add
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                continue
-            
+    def __init__(self):
+        self.null_values = False
+        self.boolean = True
+        self.integer = True
+        self.big_integer = False
+        self.float = True
+        self.datetime = True
+        self.datetime_types = set()
+        self.ampm = False
+        self.pending = set()
+        self.date_format = None
+        self.format_guesses = 0
+
+    def add(self, x):
+        if x is None:
+            self.boolean = False
+            return
+        lower = x.lower()
+        if lower in NULL_VALUES:
+            self.null_values = True
+            self.boolean = False
+            return
+        if not (self.boolean or self.integer or self.float):
+            if self.datetime:
+                self._flush_pending()
+                self._add_datetime(x)
+            return
+
+        if self.boolean and lower not in BOOLEAN_VALUES:
+            self.boolean = False
+        if self.integer:
+            self.integer = self._fits_integer(x)
+        # Anything int() takes float() takes too, so the float check only
+        # matters once the column is out of the running for integer
+        if self.float and not self.integer:
+            try:
+                float(x.replace(',', ''))
+            except ValueError:
+                self.float = False
+        if self.datetime:
+            self.pending.add(x)
+            if len(self.pending) > MAX_PENDING_DATES:
+                self._flush_pending()
+
+    def result(self):
+        """
+        Returns the column's type and whether it had null values
+        """
+        if self.boolean:
+            return Boolean, self.null_values
+        if self.integer:
+            if self.big_integer:
+                return BigInteger, self.null_values
+            return Integer, self.null_values
+        if self.float:
+            return Float, self.null_values
+        self._flush_pending()
+        if self.datetime and self.datetime_types:
+            types = set(self.datetime_types)
+            # If a mix of dates and datetimes, up-convert dates to datetimes
+            if types == set([TIMESTAMP, Date]):
+                types = set([TIMESTAMP])
+            # Datetimes and times don't mix -- fallback to using strings
+            elif types == set([TIMESTAMP, TIME]):
+                types = set([String])
+            # Dates and times don't mix -- fallback to using strings
+            elif types == set([Date, TIME]):
+                types = set([String])
+            elif types == set([TIME]) and self.ampm:
+                types = set([String])
+            return types.pop(), self.null_values
+        return String, self.null_values
+
+    def _fits_integer(self, x):
+        try:
             int_x = int(x.replace(',', ''))
-
+            # Integers padded with 0s are treated as strings
             if x[0] == '0' and int(x) != 0:
-                raise TypeError('Integer is padded with 0s, so treat it as a string instead.')
-            if x.isspace():
-                raise TypeError('Integer is nothing but spaces so falling back to string')
-
-            if 9000000000000000000 > int_x > 1000000000:
-                add(BigInteger)
-            elif 1000000000 > int_x:
-                add(Integer)
-            else:
-                raise ValueError
-
-        if BigInteger in normal_types_set:
-            return BigInteger, null_values
+                return False
+        except ValueError:
+            return False
+        if x.isspace():
+            return False
+        if 9000000000000000000 > int_x > 1000000000:
+            self.big_integer = True
+        elif not 1000000000 > int_x:
+            return False
+        return True
+
+    def _flush_pending(self):
+        pending, self.pending = self.pending, set()
+        for x in pending:
+            if not self.datetime:
+                break
+            self._add_datetime(x)
+
+    def _add_datetime(self, x):
+        d = None
+        if self.date_format is not None:
+            d = strptime_default(x, self.date_format)
+        if d is None:
+            try:
+                d = parse(x, default=DEFAULT_DATETIME)
+            except (ValueError, TypeError, OverflowError):
+                #https://bugs.launchpad.net/dateutil/+bug/1247643
+                self.datetime = False
+                return
+            if self.format_guesses < MAX_FORMAT_GUESSES:
+                self.format_guesses += 1
+                self.date_format = learn_date_format(x, d)
+        if d.date() == NULL_DATE:
+            self.datetime_types.add(TIME)
+        elif d.time() == NULL_TIME:
+            self.datetime_types.add(Date)
         else:
-            return Integer, null_values
+            self.datetime_types.add(TIMESTAMP)
+        if 'am' in x.lower() or 'pm' in x.lower():
+            self.ampm = True
 
-    except TypeError:
-        pass
-    except ValueError:
-        pass
 
-    # Are they floats?
+def strptime_default(x, date_format):
+    """
+    Reads 'x' with 'date_format', filling in the date from 
+    DEFAULT_DATETIME when the format has none (as parse does).
+    Returns None when 'x' doesn't fit the format.
+    """
     try:
-
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                continue
-
-            float_x  = float(x.replace(',', ''))
-
-        return Float, null_values
+        d = datetime.datetime.strptime(x, date_format)
     except ValueError:
-        pass
+        return None
+    if '%d' not in date_format:
+        d = datetime.datetime.combine(DEFAULT_DATETIME.date(), d.time())
+    return d
 
-    # Are they datetimes?
-    try:
-        normal_types_set = set()
-        add = normal_types_set.add
-        ampm = False
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                add(NoneType)
-                continue
- 
-            d = parse(x, default=DEFAULT_DATETIME)
- 
-            # Is it only a time?
-            if d.date() == NULL_DATE:
-                add(TIME)
-
-            # Is it only a date?
-            elif d.time() == NULL_TIME:
-                add(Date)
- 
-            # It must be a date and time
-            else:
-                add(TIMESTAMP)
-            
-            if 'am' in x.lower():
-                ampm = True
-            
-            if 'pm' in x.lower():
-                ampm = True
-
-            
-        normal_types_set.discard(NoneType)
- 
-        # If a mix of dates and datetimes, up-convert dates to datetimes
-        if normal_types_set == set([TIMESTAMP, Date]):
-            normal_types_set = set([TIMESTAMP])
-        # Datetimes and times don't mix -- fallback to using strings
-        elif normal_types_set == set([TIMESTAMP, TIME]):
-            normal_types_set = set([String])
-        # Dates and times don't mix -- fallback to using strings
-        elif normal_types_set == set([Date, TIME]):
-            normal_types_set = set([String])
-        elif normal_types_set == set([TIME]) and ampm:
-            normal_types_set = set([String])
- 
-        return normal_types_set.pop(), null_values
-    except ValueError:
-        pass
-    except TypeError: #https://bugs.launchpad.net/dateutil/+bug/1247643
-        pass
 
-    # Don't know what they are, so they must just be strings 
-    return String, null_values
+def learn_date_format(x, d):
+    """
+    Returns the first of DATE_FORMATS that reads 'x' as 'd' (what parse 
+    made of it), or None
+    """
+    if d.tzinfo is not None:
+        return None
+    for date_format in DATE_FORMATS:
+        if strptime_default(x, date_format) == d:
+            return date_format
+    return None
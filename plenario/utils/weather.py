@@ -18,6 +18,7 @@ import calendar
 from plenario.database import task_session as session, task_engine as engine, \
     Base
 from plenario.settings import DATA_DIR
+from plenario.models import CensusBlockWeatherStation
 import sqlalchemy
 from sqlalchemy import Table, Column, String, Date, DateTime, Integer, Float, \
     VARCHAR, BigInteger, and_, select, text, distinct, func
@@ -1144,11 +1145,23 @@ class WeatherETL(object):
         self.daily_table = self._get_daily_table()
         self.daily_table.append_column(Column('id', BigInteger, primary_key=True))
         self.daily_table.create(engine, checkfirst=True)
+        # Used to match records to weather in PlenarioETL._add_weather_info
+        create_index('ix_dat_weather_observations_daily_wban', 
+            'dat_weather_observations_daily', ['wban_code', 'date'])
+        # Used by /weather's cursor pages (see api.parse_cursor)
+        create_index('ix_dat_weather_observations_daily_date_id', 
+            'dat_weather_observations_daily', ['date', 'id'])
 
     def _make_hourly_table(self):
         self.hourly_table = self._get_hourly_table()
         self.hourly_table.append_column(Column('id', BigInteger, primary_key=True))
         self.hourly_table.create(engine, checkfirst=True)
+        # Used to match records to weather in PlenarioETL._add_weather_info
+        create_index('ix_dat_weather_observations_hourly_wban', 
+            'dat_weather_observations_hourly', ['wban_code', 'datetime'])
+        # Used by /weather's cursor pages (see api.parse_cursor)
+        create_index('ix_dat_weather_observations_hourly_datetime_id', 
+            'dat_weather_observations_hourly', ['datetime', 'id'])
 
     def _make_metar_table(self):
         self.metar_table = self._get_metar_table()
@@ -1476,6 +1489,32 @@ class WeatherStationsETL(object):
         # Doing this just so self.station_table is defined
         self._make_station_table()
         self._update_stations()
+        self.map_census_blocks()
+
+    def map_census_blocks(self):
+        """ 
+        Rebuilds census_block_weather_stations, the nearest weather 
+        station to the center of each census block. Does nothing until
+        the census blocks have been loaded.
+        """
+        if not engine.has_table('census_blocks'):
+            return
+        CensusBlockWeatherStation.__table__.create(engine, checkfirst=True)
+        ins = text(
+            """
+            INSERT INTO census_block_weather_stations (geoid10, wban_code)
+            SELECT c.geoid10, (
+                SELECT s.wban_code 
+                  FROM weather_stations AS s 
+                  WHERE s.location IS NOT NULL
+                  ORDER BY s.location <-> ST_Centroid(c.geom) LIMIT 1
+                )
+            FROM census_blocks AS c
+            """
+        )
+        with engine.begin() as conn:
+            conn.execute(CensusBlockWeatherStation.__table__.delete())
+            conn.execute(ins)
 
     def _extract(self):
         """ Download CSV of station info from NOAA """
@@ -1561,3 +1600,15 @@ class WeatherStationsETL(object):
 
         
         
+
+def create_index(name, table_name, columns):
+    """ 
+    Creates index 'name' on 'columns' of 'table_name' unless there already
+    is one by that name (CREATE INDEX IF NOT EXISTS needs PostgreSQL 9.5)
+    """
+    with engine.begin() as conn:
+        exists = conn.execute(text('SELECT 1 FROM pg_indexes WHERE indexname = :name'), 
+            name=name).first()
+        if exists is None:
+            conn.execute('CREATE INDEX %s ON %s (%s)' % (name, table_name, 
+                ', '.join(columns)))
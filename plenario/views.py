@@ -2,7 +2,7 @@ from flask import make_response, request, redirect, url_for, render_template, cu
     Blueprint, flash, session as flask_session
 from plenario.models import MasterTable, MetaTable, User
 from plenario.database import session, Base, app_engine as engine
-from plenario.utils.helpers import get_socrata_data_info, iter_column, send_mail, slugify
+from plenario.utils.helpers import get_socrata_data_info, infer_csv_types, send_mail, slugify
 from plenario.tasks import update_dataset as update_dataset_task, \
     delete_dataset as delete_dataset_task, add_dataset as add_dataset_task
 from flask_login import login_required
@@ -99,10 +99,8 @@ def get_context_for_new_dataset(url):
                 inp.seek(0)
                 reader = UnicodeCSVReader(inp)
                 header = reader.next()
-                col_types = []
                 inp.seek(0)
-                for col in range(len(header)):
-                    col_types.append(iter_column(col, inp)[0])
+                col_types = [t for t, null_values in infer_csv_types(inp)]
                 dataset_info['columns'] = []
                 for idx, col in enumerate(col_types):
                     d = {
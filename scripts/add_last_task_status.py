@@ -0,0 +1,24 @@
+from sqlalchemy.exc import ProgrammingError
+from plenario.database import app_engine
+
+# Adds meta_master.last_task_status to an existing database and fills it
+# in from celery_taskmeta. New tasks keep it up to date themselves.
+
+if __name__ == "__main__":
+    try:
+        with app_engine.begin() as c:
+            c.execute('ALTER TABLE meta_master ADD COLUMN last_task_status VARCHAR')
+    except ProgrammingError:
+        print 'meta_master.last_task_status already exists'
+    with app_engine.begin() as c:
+        c.execute(''' 
+            UPDATE meta_master AS m SET last_task_status = c.status
+            FROM celery_taskmeta AS c
+            WHERE c.id = (
+                SELECT id FROM celery_taskmeta 
+                WHERE task_id = ANY(m.result_ids) 
+                ORDER BY date_done DESC 
+                LIMIT 1
+            )
+        ''')
+    print 'updated meta_master.last_task_status'
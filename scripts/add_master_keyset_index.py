@@ -0,0 +1,26 @@
+from sqlalchemy.exc import ProgrammingError
+from plenario.database import app_engine
+
+# Adds the (dataset_name, obs_date, master_row_id) index that /detail's
+# cursor pages walk to dat_master in an existing database, and drops the
+# (obs_date, master_row_id) one earlier versions of this script added.
+# New databases get it from MasterTable. Both are done CONCURRENTLY so 
+# loads and queries can keep running, which can't happen inside a 
+# transaction.
+
+if __name__ == "__main__":
+    conn = app_engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        conn.execute(''' 
+            CREATE INDEX CONCURRENTLY ix_dat_master_dataset_name_obs_date_master_row_id 
+            ON dat_master (dataset_name, obs_date, master_row_id)
+        ''')
+        print 'added ix_dat_master_dataset_name_obs_date_master_row_id'
+    except ProgrammingError:
+        print 'ix_dat_master_dataset_name_obs_date_master_row_id already exists'
+    try:
+        conn.execute(''' 
+            DROP INDEX CONCURRENTLY IF EXISTS ix_dat_master_obs_date_master_row_id
+        ''')
+    finally:
+        conn.close()
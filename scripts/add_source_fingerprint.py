@@ -0,0 +1,21 @@
+from sqlalchemy.exc import ProgrammingError
+from plenario.database import app_engine
+
+# Adds the columns PlenarioETL.update uses to skip unchanged sources to
+# meta_master in an existing database. They are filled in the next time
+# each dataset is loaded.
+
+COLUMNS = [
+    ('source_etag', 'VARCHAR'),
+    ('source_last_modified', 'VARCHAR'),
+    ('source_hash', 'VARCHAR(40)'),
+]
+
+if __name__ == "__main__":
+    for name, col_type in COLUMNS:
+        try:
+            with app_engine.begin() as c:
+                c.execute('ALTER TABLE meta_master ADD COLUMN %s %s' % (name, col_type))
+            print 'added meta_master.%s' % name
+        except ProgrammingError:
+            print 'meta_master.%s already exists' % name
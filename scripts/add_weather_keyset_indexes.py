@@ -0,0 +1,28 @@
+from sqlalchemy.exc import ProgrammingError
+from plenario.database import app_engine
+
+# Adds the (date, id) and (datetime, id) indexes that /weather's cursor 
+# pages walk to the weather observation tables in an existing database.
+# WeatherETL adds them when it creates the tables. They are built 
+# CONCURRENTLY so loads and queries can keep running, which can't happen
+# inside a transaction.
+
+INDEXES = [
+    ('ix_dat_weather_observations_daily_date_id', 
+        'dat_weather_observations_daily', 'date, id'),
+    ('ix_dat_weather_observations_hourly_datetime_id', 
+        'dat_weather_observations_hourly', 'datetime, id'),
+]
+
+if __name__ == "__main__":
+    conn = app_engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for name, table, columns in INDEXES:
+            try:
+                conn.execute('CREATE INDEX CONCURRENTLY %s ON %s (%s)' \
+                    % (name, table, columns))
+                print 'added %s' % name
+            except ProgrammingError:
+                print '%s already exists' % name
+    finally:
+        conn.close()
@@ -0,0 +1,71 @@
+import sys
+import random
+import timeit
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from plenario.utils.helpers import increment_datetime_aggregate, \
+    datetime_aggregate_range, fill_datetime_aggregate
+
+# Compares the gap filling step of /timeseries before and after it was
+# replaced with datetime_aggregate_range + fill_datetime_aggregate and
+# checks that both give the same items.
+#
+# Run from the repo root so plenario is importable:
+#
+# PYTHONPATH=. python scripts/bench_gap_fill.py [datasets] [years]
+
+def dense_matrix_loop(values, from_date, to_date, agg):
+    # The loop /timeseries and /detail-aggregate used to run per dataset
+    items = []
+    dense_matrix = []
+    cursor = from_date
+    v_index = 0
+    while cursor <= to_date:
+        if v_index < len(values) and \
+            values[v_index][0].replace(tzinfo=None) == cursor:
+            dense_matrix.append((cursor, values[v_index][1]))
+            v_index += 1
+        else:
+            dense_matrix.append((cursor, 0))
+
+        cursor = increment_datetime_aggregate(cursor, agg)
+
+    dense_matrix = OrderedDict(dense_matrix)
+    for k in dense_matrix:
+        i = {
+            'datetime': k,
+            'count': dense_matrix[k],
+            }
+        items.append(i)
+    return items
+
+def make_values(from_date, to_date):
+    values = []
+    cursor = from_date
+    while cursor <= to_date:
+        if random.random() > 0.3:
+            values.append((cursor, random.randint(1, 500)))
+        cursor += timedelta(days=1)
+    return values
+
+if __name__ == "__main__":
+    datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    years = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    to_date = datetime(2015, 1, 1)
+    from_date = to_date - timedelta(days=365 * years)
+    all_values = [make_values(from_date, to_date) for d in range(datasets)]
+
+    def old():
+        return [dense_matrix_loop(v, from_date, to_date, 'day') for v in all_values]
+
+    def new():
+        buckets = datetime_aggregate_range(from_date, to_date, 'day')
+        return [fill_datetime_aggregate(buckets, v) for v in all_values]
+
+    assert old() == new()
+    old_time = min(timeit.repeat(old, number=1, repeat=5))
+    new_time = min(timeit.repeat(new, number=1, repeat=5))
+    print '%s datasets, %s years of daily buckets' % (datasets, years)
+    print 'dense matrix loop: %.3fs' % old_time
+    print 'bulk gap fill:     %.3fs' % new_time
+    print 'speedup:           %.1fx' % (old_time / new_time)
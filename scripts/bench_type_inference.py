@@ -0,0 +1,71 @@
+import sys
+import random
+import timeit
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from sqlalchemy import Date, String
+from sqlalchemy.dialects.postgresql import TIMESTAMP, TIME
+from plenario.utils.typeinference import normalize_column_type, \
+    DEFAULT_DATETIME, NULL_DATE, NULL_TIME
+
+# Compares guessing the type of date and time columns by running every
+# value through dateutil's parse (what normalize_column_type used to do)
+# with the learned strptime formats it uses now, and checks that both
+# come up with the same types.
+#
+# Run from the repo root so plenario is importable:
+#
+# PYTHONPATH=. python scripts/bench_type_inference.py [rows]
+
+FORMATS = [
+    '%m/%d/%Y %I:%M:%S %p',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+    '%m/%d/%Y',
+    '%H:%M',
+]
+
+def parse_every_value(values):
+    # The date check normalize_column_type used to run
+    types = set()
+    ampm = False
+    for x in values:
+        d = parse(x, default=DEFAULT_DATETIME)
+        if d.date() == NULL_DATE:
+            types.add(TIME)
+        elif d.time() == NULL_TIME:
+            types.add(Date)
+        else:
+            types.add(TIMESTAMP)
+        if 'am' in x.lower() or 'pm' in x.lower():
+            ampm = True
+    if types == set([TIMESTAMP, Date]):
+        types = set([TIMESTAMP])
+    elif types in (set([TIMESTAMP, TIME]), set([Date, TIME])):
+        types = set([String])
+    elif types == set([TIME]) and ampm:
+        types = set([String])
+    return types.pop()
+
+def make_column(fmt, rows):
+    start = datetime(2001, 1, 1)
+    return [(start + timedelta(seconds=random.randint(0, 10 ** 9))).strftime(fmt)
+            for i in range(rows)]
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    columns = [make_column(fmt, rows) for fmt in FORMATS]
+
+    def old():
+        return [parse_every_value(c) for c in columns]
+
+    def new():
+        return [normalize_column_type(c)[0] for c in columns]
+
+    assert old() == new()
+    old_time = min(timeit.repeat(old, number=1, repeat=3))
+    new_time = min(timeit.repeat(new, number=1, repeat=3))
+    print '%s columns of %s dates' % (len(columns), rows)
+    print 'parse every value: %.3fs' % old_time
+    print 'learned formats:   %.3fs' % new_time
+    print 'speedup:           %.1fx' % (old_time / new_time)
@@ -0,0 +1,21 @@
+from plenario.database import session
+from plenario.models import MetaTable
+from plenario.utils.etl import PlenarioETL
+from plenario.utils.weather import WeatherETL, WeatherStationsETL
+
+# Matches every census block to its nearest weather station and uses that
+# to add weather observations to records of datasets that were loaded 
+# before census_block_weather_stations existed. Safe to re-run.
+
+if __name__ == "__main__":
+    # Adds the (wban_code, date) indexes the weather matching uses
+    WeatherETL().make_tables()
+    WeatherStationsETL().map_census_blocks()
+    them = session.query(MetaTable)\
+        .filter(MetaTable.approved_status == 'true')\
+        .all()
+    for t in them:
+        e = PlenarioETL(t.as_dict())
+        e._get_tables(table_name='dat')
+        e._add_weather_info()
+        print 'added weather observations to {0}'.format(t.dataset_name)
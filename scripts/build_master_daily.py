@@ -0,0 +1,19 @@
+from plenario.database import session, app_engine
+from plenario.models import MetaTable, MasterDailyCount, MasterGridCount
+from plenario.utils.etl import PlenarioETL
+
+# Creates and fills the dat_master_daily and dat_master_grid rollups for 
+# datasets that were loaded before they existed. Safe to re-run: each dataset's counts are 
+# rebuilt from scratch.
+
+if __name__ == "__main__":
+    MasterDailyCount.__table__.create(bind=app_engine, checkfirst=True)
+    MasterGridCount.__table__.create(bind=app_engine, checkfirst=True)
+    them = session.query(MetaTable)\
+        .filter(MetaTable.approved_status == 'true')\
+        .all()
+    for t in them:
+        e = PlenarioETL(t.as_dict())
+        e._update_master_daily(added=True)
+        e._update_master_grid(added=True)
+        print 'built daily and grid counts for {0}'.format(t.dataset_name)
@@ -0,0 +1,120 @@
+import json
+import unittest
+from base64 import urlsafe_b64encode
+from datetime import datetime
+from sqlalchemy import create_engine, MetaData, Table, Column, String, \
+    Date, Boolean, Integer, select, func
+from werkzeug.datastructures import MultiDict
+from plenario.api import make_daily_query, make_cursor, parse_cursor
+
+# Observations around the 2014-01-02 and 2014-01-03 boundaries, with a
+# different number at midnight and after it on each day
+OBSERVATIONS = [
+    ('crimes', datetime(2014, 1, 1, 23, 59)),
+    ('crimes', datetime(2014, 1, 2, 0, 0)),
+    ('crimes', datetime(2014, 1, 2, 0, 0)),
+    ('crimes', datetime(2014, 1, 2, 0, 0)),
+    ('crimes', datetime(2014, 1, 2, 0, 1)),
+    ('crimes', datetime(2014, 1, 2, 12, 0)),
+    ('crimes', datetime(2014, 1, 3, 0, 0)),
+    ('crimes', datetime(2014, 1, 3, 8, 0)),
+    ('permits', datetime(2014, 1, 2, 0, 0)),
+    ('permits', datetime(2014, 1, 2, 9, 0)),
+]
+
+COMPARISONS = {
+    'ge': lambda a, b: a >= b,
+    'gt': lambda a, b: a > b,
+    'le': lambda a, b: a <= b,
+    'lt': lambda a, b: a < b,
+}
+
+class MakeDailyQueryTest(unittest.TestCase):
+    """ 
+    Counts off a daily rollup built from OBSERVATIONS the way 
+    PlenarioETL builds dat_master_daily and checks them against counting
+    the observations themselves
+    """
+
+    @classmethod
+    def setUpClass(self):
+        self.engine = create_engine('sqlite://')
+        self.daily = Table('dat_master_daily', MetaData(),
+            Column('dataset_name', String),
+            Column('obs_day', Date),
+            Column('at_midnight', Boolean),
+            Column('obs_count', Integer))
+        self.daily.create(self.engine)
+        counts = {}
+        for name, obs_date in OBSERVATIONS:
+            at_midnight = obs_date.time() == datetime.min.time()
+            key = (name, obs_date.date(), at_midnight)
+            counts[key] = counts.get(key, 0) + 1
+        self.engine.execute(self.daily.insert(), [
+            {'dataset_name': k[0], 'obs_day': k[1], 'at_midnight': k[2], 
+             'obs_count': v} for k, v in counts.items()])
+
+    def rollup_count(self, params):
+        clauses = make_daily_query(MultiDict(params), self.daily)
+        self.assertIsNot(clauses, None)
+        query = select([func.coalesce(func.sum(self.daily.c.obs_count), 0)])
+        for clause in clauses:
+            query = query.where(clause)
+        return self.engine.execute(query).scalar()
+
+    def test_day_boundaries(self):
+        for day in [datetime(2014, 1, 2), datetime(2014, 1, 3)]:
+            for operator, compare in COMPARISONS.items():
+                params = {
+                    'dataset_name': 'crimes',
+                    'obs_date__%s' % operator: day.strftime('%Y-%m-%d'),
+                }
+                expected = len([o for o in OBSERVATIONS if o[0] == 'crimes' \
+                    and compare(o[1], day)])
+                self.assertEqual(self.rollup_count(params), expected, 
+                    'obs_date__%s=%s' % (operator, day.date()))
+
+    def test_range(self):
+        params = {
+            'dataset_name__in': 'crimes,permits',
+            'obs_date__gt': '2014-01-02',
+            'obs_date__le': '2014-01-03',
+        }
+        self.assertEqual(self.rollup_count(params), 4)
+
+    def test_filters_only_dat_master_can_answer(self):
+        for params in [
+            {'obs_date__ge': '2014-01-02 08:00'},
+            {'obs_date__ge': '2014-01-02T00:00:00+05:00'},
+            {'obs_date__ge': 'someday'},
+            {'obs_date__ne': '2014-01-02'},
+            {'location_geom__within': '{}'},
+            {'primary_type': 'THEFT'},
+            {'census_block__like': '17031%'},
+        ]:
+            self.assertEqual(make_daily_query(MultiDict(params), self.daily), 
+                None, params)
+
+    def test_ignores_paging(self):
+        params = {'dataset_name': 'permits', 'limit': '10', 'offset': '5'}
+        self.assertEqual(self.rollup_count(params), 2)
+
+class ParseCursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        token = make_cursor(datetime(2014, 1, 2, 3, 4, 5), 42)
+        self.assertEqual(parse_cursor(token), (datetime(2014, 1, 2, 3, 4, 5), 42))
+
+    def test_first_page(self):
+        self.assertEqual(parse_cursor(''), (None, None))
+
+    def test_bad_cursors(self):
+        for payload in ['nope', json.dumps(['2014-01-02']), 
+            json.dumps(['2014-13-45', 1]), json.dumps(['2014-01-02', 'x']),
+            json.dumps(['99999999999999999999-01-01', 1]),
+            json.dumps([None, 1])]:
+            self.assertRaises(ValueError, parse_cursor, 
+                urlsafe_b64encode(payload))
+        self.assertRaises(ValueError, parse_cursor, '!!!')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from hashlib import sha1
+from plenario.utils.etl import TeeReader
+
+CHUNKS = ['a,b\n1,', '', '2\n3,4', '\n5,6\n']
+DATA = ''.join(CHUNKS)
+
+class TeeReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'source.csv.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def archived(self):
+        with gzip.open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_readline(self):
+        f = TeeReader(CHUNKS, self.path)
+        self.assertEqual([f.readline() for i in range(5)], 
+            ['a,b\n', '1,2\n', '3,4\n', '5,6\n', ''])
+        f.close()
+        self.assertEqual(self.archived(), DATA)
+
+    def test_read(self):
+        f = TeeReader(CHUNKS, self.path)
+        self.assertEqual(f.read(3), 'a,b')
+        self.assertEqual(f.readline(), '\n')
+        self.assertEqual(f.read(), DATA[4:])
+        self.assertEqual(f.read(), '')
+        f.close()
+
+    def test_close_archives_unread_chunks(self):
+        f = TeeReader(CHUNKS, self.path)
+        f.readline()
+        self.assertTrue(os.path.exists('%s.part' % self.path))
+        self.assertFalse(os.path.exists(self.path))
+        f.close()
+        self.assertFalse(os.path.exists('%s.part' % self.path))
+        self.assertEqual(self.archived(), DATA)
+        self.assertEqual(f.hash.hexdigest(), sha1(DATA).hexdigest())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import random
+import unittest
+from cStringIO import StringIO
+from datetime import datetime
+from dateutil.tz import tzutc
+from sqlalchemy import Integer, String
+from plenario.utils import helpers
+from plenario.utils.helpers import infer_csv_types, fill_datetime_aggregate, \
+    datetime_aggregate_range
+from plenario.utils.typeinference import ColumnTypeGuess
+
+def make_csv(rows):
+    return StringIO('\n'.join(['a,b'] + rows) + '\n')
+
+class CountingGuess(ColumnTypeGuess):
+    added = []
+
+    def add(self, x):
+        CountingGuess.added.append(x)
+        ColumnTypeGuess.add(self, x)
+
+class InferCsvTypesTest(unittest.TestCase):
+    def setUp(self):
+        CountingGuess.added = []
+        helpers.ColumnTypeGuess = CountingGuess
+
+    def tearDown(self):
+        helpers.ColumnTypeGuess = ColumnTypeGuess
+
+    def test_every_row(self):
+        f = make_csv(['%s,x' % i for i in range(50)] + ['oops,y'])
+        self.assertEqual(infer_csv_types(f), [(String, False), (String, False)])
+        self.assertEqual(len(CountingGuess.added), 102)
+
+    def test_head_and_sample(self):
+        f = make_csv(['%s,x' % i for i in range(100)])
+        infer_csv_types(f, sample_size=10, head_size=5)
+        values = CountingGuess.added[::2]
+        self.assertEqual(len(values), 15)
+        self.assertEqual(values[:5], ['0', '1', '2', '3', '4'])
+        self.assertEqual(len(set(values[5:])), 10)
+        self.assertTrue(all(int(v) >= 5 for v in values[5:]))
+
+    def test_head_is_always_checked(self):
+        f = make_csv(['oops,x'] + ['%s,x' % i for i in range(100)])
+        types = infer_csv_types(f, sample_size=10, head_size=1)
+        self.assertEqual(types[0], (String, False))
+
+    def test_short_tail(self):
+        f = make_csv(['%s,x' % i for i in range(8)])
+        types = infer_csv_types(f, sample_size=10, head_size=2)
+        self.assertEqual(types[0], (Integer, False))
+        self.assertEqual(len(CountingGuess.added), 16)
+
+    def test_sample_is_uniform(self):
+        # Every row after the head should make it into the reservoir
+        # about sample_size / rows of the time
+        random.seed(0)
+        rows, sample_size, runs = 20, 5, 2000
+        hits = dict((str(i), 0) for i in range(rows))
+        for run in range(runs):
+            CountingGuess.added = []
+            f = make_csv(['%s,x' % i for i in range(rows)])
+            infer_csv_types(f, sample_size=sample_size, head_size=0)
+            for v in CountingGuess.added[::2]:
+                hits[v] += 1
+        for v, n in hits.items():
+            self.assertAlmostEqual(float(n) / runs, 
+                float(sample_size) / rows, delta=0.05)
+
+class FillDatetimeAggregateTest(unittest.TestCase):
+    def test_fills_empty_buckets(self):
+        buckets = datetime_aggregate_range(datetime(2014, 1, 1), 
+            datetime(2014, 4, 1), 'month')
+        values = [
+            (datetime(2014, 1, 1, tzinfo=tzutc()), 3),
+            (datetime(2014, 3, 1, tzinfo=tzutc()), 5),
+        ]
+        self.assertEqual(fill_datetime_aggregate(buckets, values), [
+            {'datetime': datetime(2014, 1, 1), 'count': 3},
+            {'datetime': datetime(2014, 2, 1), 'count': 0},
+            {'datetime': datetime(2014, 3, 1), 'count': 5},
+            {'datetime': datetime(2014, 4, 1), 'count': 0},
+        ])
+
+    def test_no_values(self):
+        buckets = datetime_aggregate_range(datetime(2014, 1, 1), 
+            datetime(2014, 1, 3), 'day')
+        self.assertEqual([i['count'] for i in fill_datetime_aggregate(buckets, [])], 
+            [0, 0, 0])
+
+    def test_values_outside_buckets_are_dropped(self):
+        buckets = [datetime(2014, 1, 1)]
+        values = [(datetime(2013, 1, 1), 4), (datetime(2014, 1, 1), 2)]
+        self.assertEqual(fill_datetime_aggregate(buckets, values), 
+            [{'datetime': datetime(2014, 1, 1), 'count': 2}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+from datetime import datetime
+from dateutil.parser import parse
+from sqlalchemy import Boolean, Integer, BigInteger, Float, Date, String
+from sqlalchemy.dialects.postgresql import TIMESTAMP, TIME
+from plenario.utils import typeinference
+from plenario.utils.typeinference import ColumnTypeGuess, \
+    normalize_column_type, learn_date_format, DEFAULT_DATETIME
+
+class ColumnTypeGuessTest(unittest.TestCase):
+    def test_boolean(self):
+        self.assertEqual(normalize_column_type(['t', 'F', 'yes', 'N']), 
+            (Boolean, False))
+
+    def test_integer(self):
+        self.assertEqual(normalize_column_type(['1', '2,000', '-3']), 
+            (Integer, False))
+
+    def test_big_integer(self):
+        self.assertEqual(normalize_column_type(['1', '20000000000']), 
+            (BigInteger, False))
+
+    def test_zero_padded_integers_are_not_integers(self):
+        self.assertEqual(normalize_column_type(['1', '007']), 
+            (Float, False))
+
+    def test_float(self):
+        self.assertEqual(normalize_column_type(['1', '2.5', '1,000.25']), 
+            (Float, False))
+
+    def test_null_values(self):
+        self.assertEqual(normalize_column_type(['1', 'NA', '', '2']), 
+            (Integer, True))
+
+    def test_dates(self):
+        self.assertEqual(normalize_column_type(['2014-01-01', '01/02/2014']), 
+            (Date, False))
+
+    def test_dates_and_datetimes_are_datetimes(self):
+        values = ['2014-01-01', '2014-01-02 13:45:00']
+        self.assertEqual(normalize_column_type(values), (TIMESTAMP, False))
+
+    def test_dates_and_times_are_strings(self):
+        self.assertEqual(normalize_column_type(['2014-01-01', '13:45']), 
+            (String, False))
+
+    def test_times(self):
+        self.assertEqual(normalize_column_type(['13:45', '08:30:15']), 
+            (TIME, False))
+
+    def test_ampm_times_are_strings(self):
+        self.assertEqual(normalize_column_type(['1:45 PM', '8:30 AM']), 
+            (String, False))
+
+    def test_strings(self):
+        self.assertEqual(normalize_column_type(['2014-01-01', 'soon']), 
+            (String, False))
+
+    def test_pending_dates_are_flushed(self):
+        old = typeinference.MAX_PENDING_DATES
+        typeinference.MAX_PENDING_DATES = 2
+        try:
+            column = ColumnTypeGuess()
+            for day in range(1, 6):
+                column.add('2014-01-%02d' % day)
+            self.assertTrue(len(column.pending) <= 2)
+            column.add('later')
+            self.assertEqual(column.result(), (String, False))
+        finally:
+            typeinference.MAX_PENDING_DATES = old
+
+    def test_same_types_as_parse(self):
+        # Learned formats have to come up with what parse alone would
+        values = ['12/31/2014 11:59:59 PM', '01/01/2015 12:00:00 AM', 
+            '02/03/2015 01:02:03 PM']
+        column = ColumnTypeGuess()
+        for x in values:
+            column.add(x)
+        self.assertEqual(column.date_format, '%m/%d/%Y %I:%M:%S %p')
+        self.assertEqual(column.result(), (TIMESTAMP, False))
+
+class LearnDateFormatTest(unittest.TestCase):
+    def learn(self, x):
+        return learn_date_format(x, parse(x, default=DEFAULT_DATETIME))
+
+    def test_formats(self):
+        self.assertEqual(self.learn('12/31/2014 01:02:03 PM'), 
+            '%m/%d/%Y %I:%M:%S %p')
+        self.assertEqual(self.learn('2014-12-31T13:02:03'), '%Y-%m-%dT%H:%M:%S')
+        self.assertEqual(self.learn('2014-12-31'), '%Y-%m-%d')
+        self.assertEqual(self.learn('12/31/2014'), '%m/%d/%Y')
+        self.assertEqual(self.learn('13:02'), '%H:%M')
+
+    def test_unknown_format(self):
+        self.assertEqual(self.learn('Dec 31 2014'), None)
+
+    def test_timezones_are_not_learned(self):
+        self.assertEqual(self.learn('2014-12-31T13:02:03+05:00'), None)
+
+    def test_format_has_to_agree_with_parse(self):
+        # strptime reads this as January 2nd, which is not what it was
+        # parsed as
+        self.assertEqual(learn_date_format('01/02/2014', datetime(2014, 2, 1)), 
+            None)
+
+if __name__ == "__main__":
+    unittest.main()